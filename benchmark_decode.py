@@ -0,0 +1,80 @@
+"""Compare the CPU cost of the QueuedStream decode options on a camera or a clip.
+
+Usage: python3 benchmark_decode.py <uri> [--seconds 20] [--decode-fps 5] [--consumer-fps 5] [--size 720 576]
+       [--pipeline "..."]
+
+Cores per stream is the CPU time of the process divided by the wall time, so run nothing else meanwhile."""
+
+import argparse
+import resource
+import time
+
+from videostream import QueuedStream
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(uri, seconds, consumer_fps, **options):
+    video = QueuedStream(uri, True, 25, **options)
+    video.start()
+    if not video.isOpened():
+        return None
+    start_cpu = cpu_time()
+    start = time.time()
+    frames = 0
+    shape = None
+    while time.time() - start < seconds:
+        ret, frame, _ = video.read()
+        if not ret:
+            break
+        frames += 1
+        shape = frame.shape[:2]
+        if consumer_fps > 0:
+            # stands for the processing of the frame
+            time.sleep(1.0 / consumer_fps)
+    elapsed = time.time() - start
+    cores = (cpu_time() - start_cpu) / elapsed
+    stats = video.get_stats()
+    video.release()
+    return shape, stats['grabbed'] / elapsed, stats['decoded'] / elapsed, frames / elapsed, cores
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark video decode options')
+    parser.add_argument('uri', help='camera uri or video file')
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--decode-fps', type=float, default=5, help='decode rate of the grab skipping run')
+    parser.add_argument('--consumer-fps', type=float, default=0, help='rate the frames are read at, 0 is unlimited')
+    parser.add_argument('--size', type=int, nargs=2, default=None, metavar=('WIDTH', 'HEIGHT'),
+                        help='decode size asked to the backend')
+    parser.add_argument('--pipeline', default='', help='GStreamer pipeline with {uri}, {width}, {height}')
+    args = parser.parse_args()
+
+    decode_size = tuple(args.size) if args.size is not None else None
+    runs = [
+        ('full decode', dict(decode_fps=0, pipeline='', hw_decode=False, consumer_paced=False)),
+        ('reduced size', dict(decode_size=decode_size, decode_fps=0, pipeline='', hw_decode=False, consumer_paced=False)),
+        ('grab skipping', dict(decode_size=decode_size, decode_fps=args.decode_fps, pipeline='', hw_decode=False,
+                               consumer_paced=False)),
+        ('consumer paced', dict(decode_size=decode_size, decode_fps=0, pipeline='', hw_decode=False,
+                                consumer_paced=True)),
+        ('hw decode', dict(decode_size=decode_size, decode_fps=0, pipeline='', hw_decode=True, consumer_paced=False)),
+    ]
+    if args.pipeline:
+        runs.append(('pipeline', dict(decode_size=decode_size, decode_fps=0, pipeline=args.pipeline,
+                                      consumer_paced=False)))
+
+    print('{:<14} {:>11} {:>10} {:>10} {:>9} {:>7}'.format('mode', 'size', 'grab fps', 'decode fps', 'read fps',
+                                                            'cores'))
+    for name, options in runs:
+        res = run(args.uri, args.seconds, args.consumer_fps, **options)
+        if res is None:
+            print('{:<14} cannot open'.format(name))
+            continue
+        shape, grab_fps, decode_fps, read_fps, cores = res
+        size = '{}x{}'.format(shape[1], shape[0]) if shape is not None else '-'
+        print('{:<14} {:>11} {:>10.1f} {:>10.1f} {:>9.1f} {:>7.2f}'.format(name, size, grab_fps, decode_fps, read_fps,
+                                                                          cores))
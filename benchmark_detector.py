@@ -0,0 +1,72 @@
+"""Compare speed and memory of the human detection backends on a recorded clip.
+
+Usage: python3 benchmark_detector.py <video> [--backends tensorflow opencv onnxruntime] [--frames 200]
+
+Each backend runs in its own process, so the peak RSS reported is that of the backend alone."""
+
+import argparse
+import resource
+import time
+from multiprocessing import Process, Queue
+
+import cv2
+
+import config_main
+import utils_main
+from detector_backend import HUMAN_BACKENDS, create_human_backend
+
+
+def read_clip(path, max_frames):
+    video = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < max_frames:
+        ret, frame = video.read()
+        if not ret:
+            break
+        frames.append(utils_main.resize_max_size(
+            frame, config_main.data['PROCESS_WIDTH'], config_main.data['PROCESS_HEIGHT']))
+    video.release()
+    return frames
+
+
+def run_backend(name, frames, batch_size, out_queue):
+    start = time.time()
+    backend = create_human_backend(name)
+    backend.load()
+    load_time = time.time() - start
+    # warm up
+    backend.detect_batch(frames[:batch_size])
+    start = time.time()
+    for i in range(0, len(frames), batch_size):
+        backend.detect_batch(frames[i:i + batch_size])
+    elapsed = time.time() - start
+    backend.close()
+    # ru_maxrss is in kilobytes on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    out_queue.put((name, load_time, len(frames) / elapsed, max_rss))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark human detection backends')
+    parser.add_argument('video', help='recorded clip')
+    parser.add_argument('--backends', nargs='+', default=list(HUMAN_BACKENDS), choices=list(HUMAN_BACKENDS))
+    parser.add_argument('--frames', type=int, default=200, help='number of frames to run')
+    parser.add_argument('--batch-size', type=int, default=1)
+    args = parser.parse_args()
+
+    frames = read_clip(args.video, args.frames)
+    if len(frames) == 0:
+        print('Cannot read', args.video)
+        exit(1)
+    print('Frames:', len(frames), 'size:', frames[0].shape[:2], 'batch size:', args.batch_size)
+    print('{:<12} {:>10} {:>8} {:>12}'.format('backend', 'load (s)', 'fps', 'max RSS (MB)'))
+    for name in args.backends:
+        out_queue = Queue()
+        p = Process(target=run_backend, args=(name, frames, args.batch_size, out_queue))
+        p.start()
+        p.join()
+        if out_queue.empty():
+            print('{:<12} failed, exit code {}'.format(name, p.exitcode))
+            continue
+        name, load_time, fps, max_rss = out_queue.get()
+        print('{:<12} {:>10.2f} {:>8.2f} {:>12.1f}'.format(name, load_time, fps, max_rss))
@@ -0,0 +1,58 @@
+"""Compare the heatmap blending implementations on random frames.
+
+Usage: python3 benchmark_heatmap.py [--size 1280 720] [--repeat 50]
+
+The first legacy call includes the numba compile, it is timed apart."""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+import utils_main
+from heatmap import RATIO
+
+
+def make_heatmap(width, height):
+    hmap = np.random.rand(int(height * RATIO), int(width * RATIO))
+    hmap = cv2.GaussianBlur(hmap, (0, 0), 5)
+    return hmap / hmap.max()
+
+
+def timeit(func, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark heatmap blending')
+    parser.add_argument('--size', type=int, nargs=2, default=(1280, 720), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--power', type=float, default=1.0)
+    args = parser.parse_args()
+
+    width, height = args.size
+    frame = np.random.randint(0, 256, (height, width, 3), dtype='uint8')
+    hmap = make_heatmap(width, height)
+
+    start = time.time()
+    legacy = utils_main.blend_heatmap_legacy(frame, hmap, args.power)
+    first_call = (time.time() - start) * 1000
+    lut = utils_main.blend_heatmap(frame, hmap, args.power)
+    diff = np.abs(legacy.astype('int32') - lut)
+    print('max difference {}, mean difference {:.3f}'.format(diff.max(), diff.mean()))
+
+    blender = utils_main.HeatmapBlender()
+    blender.blend(frame, hmap, args.power, version=0)
+    print('{:<22} {:>8}'.format('implementation', 'ms'))
+    print('{:<22} {:>8.2f}'.format('legacy, first call', first_call))
+    print('{:<22} {:>8.2f}'.format('legacy', timeit(lambda: utils_main.blend_heatmap_legacy(frame, hmap, args.power),
+                                                    args.repeat)))
+    print('{:<22} {:>8.2f}'.format('lut', timeit(lambda: utils_main.blend_heatmap(frame, hmap, args.power),
+                                                 args.repeat)))
+    # a new frame with the same heatmap, as on the display
+    print('{:<22} {:>8.2f}'.format('lut, cached heatmap', timeit(lambda: blender.blend(frame, hmap, args.power, 0),
+                                                                 args.repeat)))
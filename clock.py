@@ -0,0 +1,41 @@
+"""Time source of the processing stages: the wall clock live, the video time when replaying a recording."""
+
+import datetime
+import time
+
+import config_main
+
+# process a recorded file as fast as possible, with the time taken from the video
+REPLAY = config_main.data['REPLAY']
+# wall time of the first frame of the recording, '%Y-%m-%d %H:%M:%S', empty for now
+REPLAY_START = config_main.data['REPLAY_START']
+
+
+def replay_start_time(start=REPLAY_START):
+    """Epoch time the replayed recording starts at"""
+    if len(start) == 0:
+        return time.time()
+    return datetime.datetime.strptime(start, '%Y-%m-%d %H:%M:%S').timestamp()
+
+
+class Clock:
+    """Wall clock"""
+
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.time())
+
+
+class VideoClock(Clock):
+    """Time of the frame being processed, the processing loop sets it from the frame timestamps"""
+
+    def __init__(self, start):
+        self.current = start
+
+    def set(self, timestamp):
+        self.current = timestamp
+
+    def time(self):
+        return self.current
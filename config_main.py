@@ -15,3 +15,10 @@ def reload():
     global data
     with open(config_file) as fi:
         data = json.load(fi)
+
+
+def load(path):
+    """Use another config file, before the modules reading the config are imported"""
+    global config_file
+    config_file = path
+    reload()
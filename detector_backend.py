@@ -0,0 +1,136 @@
+"""Detection engines. A backend is created in the process that runs it and loads its model in load(),
+so heavy frameworks like TensorFlow are only imported by the backend that needs them."""
+
+import os
+
+import cv2
+import numpy as np
+
+import config_main
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+MODEL_DIR = os.path.join(THIS_DIR, 'data_main', config_main.data['DETECTION_MODEL'])
+PATH_TO_CKPT = os.path.join(MODEL_DIR, 'frozen_inference_graph.pb')
+# text graph for cv2.dnn, generated by opencv's tf_text_graph_*.py scripts
+PATH_TO_PBTXT = os.path.join(MODEL_DIR, 'graph.pbtxt')
+# the same graph exported with tf2onnx
+PATH_TO_ONNX = os.path.join(MODEL_DIR, 'model.onnx')
+
+
+class DetectorBackend:
+    """Interface of a detector. detect_batch takes a list of BGR images and returns one result per image,
+    detect is the single image shortcut. Every backend feeds the images to the model in that BGR order, as the
+    TensorFlow detection always did, so switching backends does not change the detections"""
+    name = None
+
+    def load(self):
+        pass
+
+    def detect_batch(self, images):
+        raise NotImplementedError
+
+    def detect(self, img):
+        return self.detect_batch([img])[0]
+
+    def close(self):
+        pass
+
+
+class TFHumanBackend(DetectorBackend):
+    """TF1 frozen graph from the object detection API.
+    Result of each image: boxes (n, 4) as relative (ymin, xmin, ymax, xmax), scores (n,) sorted, classes (n,)"""
+    name = 'tensorflow'
+
+    def load(self):
+        import tensorflow as tf
+        if config_main.data['HUMAN_DETECTION_GPU'] < 0:
+            device = '/device:CPU:0'
+            my_devices = tf.config.experimental.list_physical_devices(device_type='CPU')
+            tf.config.experimental.set_visible_devices(devices=my_devices, device_type='CPU')
+            config = tf.ConfigProto(device_count={'GPU': 0})
+        else:
+            device = '/GPU:' + str(config_main.data['HUMAN_DETECTION_GPU'])
+            os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'true'
+            config = tf.ConfigProto()
+            config.gpu_options.allow_growth = True
+        with tf.device(device):
+            detection_graph = tf.Graph()
+            with detection_graph.as_default():
+                od_graph_def = tf.GraphDef()
+                with tf.gfile.GFile(PATH_TO_CKPT, 'rb') as fid:
+                    serialized_graph = fid.read()
+                    od_graph_def.ParseFromString(serialized_graph)
+                    tf.import_graph_def(od_graph_def, name='')
+        self.sess = tf.Session(graph=detection_graph, config=config)
+        # Get input and output tensors
+        self.image_tensor = detection_graph.get_tensor_by_name('image_tensor:0')
+        self.outputs = [detection_graph.get_tensor_by_name('detection_boxes:0'),
+                        detection_graph.get_tensor_by_name('detection_scores:0'),
+                        detection_graph.get_tensor_by_name('detection_classes:0')]
+
+    def detect_batch(self, images):
+        if len(images) == 1:
+            images = np.expand_dims(images[0], axis=0)
+        else:
+            images = np.stack(images)
+        boxes, scores, classes = self.sess.run(self.outputs, feed_dict={self.image_tensor: images})
+        return list(zip(boxes, scores, classes))
+
+    def close(self):
+        self.sess.close()
+
+
+class OpenCVHumanBackend(DetectorBackend):
+    """The same frozen graph run by cv2.dnn, no TensorFlow needed. Same result layout as TFHumanBackend"""
+    name = 'opencv'
+
+    def load(self):
+        self.net = cv2.dnn.readNetFromTensorflow(PATH_TO_CKPT, PATH_TO_PBTXT)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+    def detect_batch(self, images):
+        im_height, im_width = images[0].shape[:2]
+        # no swapRB, the model gets BGR like in TFHumanBackend
+        blob = cv2.dnn.blobFromImages(images, size=(im_width, im_height), swapRB=False, crop=False)
+        self.net.setInput(blob)
+        # (1, 1, N, 7): image index, class id, score, left, top, right, bottom
+        out = self.net.forward()[0, 0]
+        results = []
+        for i in range(len(images)):
+            rows = out[out[:, 0] == i]
+            rows = rows[np.argsort(-rows[:, 2])]
+            boxes = rows[:, [4, 3, 6, 5]]
+            # cv2.dnn class ids start from 0, the label map starts from 1
+            results.append((boxes, rows[:, 2], rows[:, 1] + 1))
+        return results
+
+
+class OnnxHumanBackend(DetectorBackend):
+    """The graph exported to ONNX, run by onnxruntime on CPU. Same result layout as TFHumanBackend"""
+    name = 'onnxruntime'
+
+    def load(self):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(PATH_TO_ONNX, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        # tf2onnx may keep the ':0' suffix of the tensor names
+        names = [o.name for o in self.session.get_outputs()]
+        self.output_names = [next(n for n in names if n.startswith(prefix))
+                             for prefix in ('detection_boxes', 'detection_scores', 'detection_classes')]
+
+    def detect_batch(self, images):
+        images = np.stack(images).astype(np.uint8, copy=False)
+        boxes, scores, classes = self.session.run(self.output_names, {self.input_name: images})
+        return list(zip(boxes, scores, classes))
+
+
+HUMAN_BACKENDS = {backend.name: backend for backend in (TFHumanBackend, OpenCVHumanBackend, OnnxHumanBackend)}
+
+
+def create_human_backend(name=None):
+    if name is None:
+        name = config_main.data['DETECTION_BACKEND']
+    if name not in HUMAN_BACKENDS:
+        raise ValueError('Unknown detection backend: {}, available: {}'.format(name, list(HUMAN_BACKENDS)))
+    return HUMAN_BACKENDS[name]()
@@ -0,0 +1,214 @@
+"""Human detection shared by several cameras: a pool of worker processes, each loading the model once,
+fed by any number of streams with fair round-robin scheduling."""
+
+import queue
+import threading
+import time
+from ctypes import c_bool
+from multiprocessing import Process, Queue, Value
+
+import config_main
+from human_detection import BATCH_SIZE, BATCH_TIMEOUT_MS, HumanDetector, create_counters, throughput_stats
+
+NUM_WORKERS = config_main.data['DETECTION_WORKERS']
+
+
+class StreamClient:
+    """Handle of one stream on the service, with the same interface as HumanDetector so it can replace it"""
+
+    def __init__(self, service, stream_id, result_size):
+        self.service = service
+        self.stream_id = stream_id
+        self.pending = None  # latest frame waiting to be scheduled
+        self.out_queue = queue.Queue(maxsize=result_size)
+        self.submitted = 0
+        self.dropped = 0
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.service.unregister_stream(self.stream_id)
+
+    def put_frame(self, frame_id, img):
+        """Submit a frame, replacing the frame of this stream that is not scheduled yet. Always True, like
+        HumanDetector.put_frame for a frame that was queued"""
+        self.service._submit(self, frame_id, img)
+        return True
+
+    def get_result(self, block=True):
+        try:
+            return self.out_queue.get(block)
+        except queue.Empty:
+            return None
+
+    def get_results(self):
+        """Return all results that are currently available, oldest first"""
+        results = []
+        while True:
+            res = self.get_result(block=False)
+            if res is None:
+                return results
+            results.append(res)
+
+    def get_throughput(self):
+        stats = self.service.get_throughput()
+        stats['stream_submitted'] = self.submitted
+        stats['stream_dropped'] = self.dropped
+        return stats
+
+    def _put_result(self, result):
+        if self.out_queue.full():
+            try:
+                self.out_queue.get(False)
+            except queue.Empty:
+                pass
+        self.out_queue.put(result)
+
+
+class DetectorService:
+
+    def __init__(self, num_workers=NUM_WORKERS, batch_size=BATCH_SIZE, batch_timeout_ms=BATCH_TIMEOUT_MS, backend=None):
+        self.num_workers = max(1, num_workers)
+        self.batch_size = max(1, batch_size)
+        self.batch_timeout = batch_timeout_ms / 1000.0
+        self.backend = backend if backend is not None else config_main.data['DETECTION_BACKEND']
+        # at most one batch waiting per worker, the rest waits in the streams so it stays fresh
+        self.task_queue = Queue(maxsize=self.num_workers * self.batch_size)
+        self.result_queue = Queue()
+        self.stopped = Value(c_bool, False)
+        self.counters = create_counters()
+        self.start_time = None
+        self.streams = dict()
+        self.next_stream = 0
+        self.condition = threading.Condition()
+        self.processes = []
+        self.scheduler_thread = None
+        self.router_thread = None
+
+    def start(self):
+        for _ in range(self.num_workers):
+            # workers tag results with (stream_id, frame_id), the result queue is never dropped
+            p = Process(target=HumanDetector._run_function,
+                        args=(self.task_queue, self.result_queue, self.stopped,
+                              self.batch_size, self.batch_timeout, self.counters, None, self.backend))
+            p.daemon = True
+            p.start()
+            self.processes.append(p)
+        self.scheduler_thread = threading.Thread(target=self._schedule)
+        self.scheduler_thread.daemon = True
+        self.scheduler_thread.start()
+        self.router_thread = threading.Thread(target=self._route)
+        self.router_thread.daemon = True
+        self.router_thread.start()
+        self.start_time = time.time()
+
+    def stop(self):
+        if self.stopped.value:
+            return
+        self.stopped.value = True
+        with self.condition:
+            self.condition.notify_all()
+        self.scheduler_thread.join()
+        for _ in self.processes:
+            try:
+                self.task_queue.put((None, None, None), False)
+            except Exception:
+                pass
+        for p in self.processes:
+            p.join()
+        self.result_queue.put(None)
+        self.router_thread.join()
+
+    def register_stream(self, stream_id=None):
+        """Return a StreamClient for a new stream"""
+        with self.condition:
+            if stream_id is None:
+                stream_id = len(self.streams)
+                while stream_id in self.streams:
+                    stream_id += 1
+            if stream_id in self.streams:
+                raise ValueError('Stream {} is already registered'.format(stream_id))
+            client = StreamClient(self, stream_id, self.batch_size)
+            self.streams[stream_id] = client
+        return client
+
+    def unregister_stream(self, stream_id):
+        with self.condition:
+            self.streams.pop(stream_id, None)
+
+    def get_throughput(self):
+        stats = throughput_stats(self.counters, self.start_time)
+        stats['workers'] = self.num_workers
+        stats['streams'] = len(self.streams)
+        return stats
+
+    def _submit(self, client, frame_id, img):
+        with self.condition:
+            if client.pending is not None:
+                client.dropped += 1
+            client.pending = (frame_id, img, time.time())
+            client.submitted += 1
+            self.condition.notify()
+
+    def _next_task(self):
+        """Take the pending frame of the next stream in round-robin order, wait if there is none"""
+        with self.condition:
+            while not self.stopped.value:
+                stream_ids = list(self.streams.keys())
+                n = len(stream_ids)
+                for i in range(n):
+                    client = self.streams[stream_ids[(self.next_stream + i) % n]]
+                    if client.pending is not None:
+                        self.next_stream = (self.next_stream + i + 1) % n
+                        frame_id, img, put_time = client.pending
+                        client.pending = None
+                        return (client.stream_id, frame_id), img, put_time
+                self.condition.wait(0.5)
+        return None
+
+    def _schedule(self):
+        while not self.stopped.value:
+            task = self._next_task()
+            if task is None:
+                break
+            # blocks while all workers are busy, newer frames keep replacing the pending ones meanwhile
+            while not self.stopped.value:
+                try:
+                    self.task_queue.put(task, True, 0.5)
+                    break
+                except queue.Full:
+                    pass
+
+    def _route(self):
+        while True:
+            res = self.result_queue.get()
+            if res is None:
+                break
+            (stream_id, frame_id), scores, classes, boxes = res
+            with self.condition:
+                client = self.streams.get(stream_id)
+            if client is not None:
+                client._put_result((frame_id, scores, classes, boxes))
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    """Return the detector service of this process, start it on the first call"""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = DetectorService()
+            _service.start()
+        return _service
+
+
+def stop_service():
+    global _service
+    with _service_lock:
+        if _service is not None:
+            _service.stop()
+            _service = None
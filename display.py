@@ -0,0 +1,114 @@
+import threading
+import time
+
+import cv2
+import numpy as np
+from PyQt5 import QtCore, QtGui
+
+import utils_main
+
+
+class DisplayWorker(QtCore.QThread):
+    """Turn the frames of a pipeline into images for a label, off the GUI thread.
+    Only the newest frame is kept, at most one image per screen refresh is sent and nothing is done while hidden"""
+    updateImage = QtCore.pyqtSignal(QtGui.QImage)
+
+    def __init__(self, refresh_rate=60.0):
+        super(DisplayWorker, self).__init__()
+        self.interval = 1.0 / refresh_rate
+        self.cond = threading.Condition()
+        # newest frame, BGR at display size
+        self.frame = None
+        self.heatmap = None
+        # counts the heatmaps set, the blender keeps the colourised heatmap while it stays the same
+        self.heatmap_version = 0
+        self.new_frame = False
+        self.visible = True
+        self.heatmap_enabled = False
+        self.heatmap_power = 1.0
+        # an image was sent and the GUI has not drawn it yet
+        self.pending = False
+        self.stopped = False
+        # the images point into these, the GUI draws from one while the next frame goes to the other
+        self.buffers = [None, None]
+        self.buffer_index = 0
+        # keeps the colourised heatmap between the frames
+        self.blender = utils_main.HeatmapBlender()
+
+    def put_frame(self, frame):
+        """Called from the pipeline thread for every frame, replaces the frame not shown yet"""
+        with self.cond:
+            self.frame = frame
+            self.new_frame = True
+            self.cond.notify()
+
+    def set_heatmap(self, hmap):
+        with self.cond:
+            self.heatmap = hmap
+            self.heatmap_version += 1
+
+    def set_heatmap_options(self, enabled, power):
+        with self.cond:
+            self.heatmap_enabled = enabled
+            self.heatmap_power = power
+            # show the change on the current frame
+            self.new_frame = self.frame is not None
+            self.cond.notify()
+
+    def set_visible(self, visible):
+        with self.cond:
+            if visible and not self.visible:
+                self.new_frame = self.frame is not None
+            self.visible = visible
+            self.cond.notify()
+
+    def drawn(self):
+        """The GUI is done with the last image"""
+        with self.cond:
+            self.pending = False
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.wait()
+        self.frame = None
+        self.heatmap = None
+
+    def run(self):
+        self.stopped = False
+        last_time = 0
+        while True:
+            with self.cond:
+                while not self.stopped and not (self.new_frame and self.visible and not self.pending):
+                    self.cond.wait()
+                if self.stopped:
+                    break
+            # frames coming meanwhile replace each other, only the newest one is drawn
+            delay = last_time + self.interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            with self.cond:
+                frame = self.frame
+                hmap = self.heatmap if self.heatmap_enabled else None
+                version = self.heatmap_version
+                power = self.heatmap_power
+                self.new_frame = False
+                self.pending = True
+            image = self._render(frame, hmap, power, version)
+            last_time = time.time()
+            self.updateImage.emit(image)
+
+    def _render(self, frame, hmap, power, version):
+        if hmap is not None:
+            frame = self.blender.blend(frame, hmap, power, version)
+        buf = self.buffers[self.buffer_index]
+        if buf is None or buf.shape != frame.shape:
+            buf = np.empty(frame.shape, dtype='uint8')
+            self.buffers[self.buffer_index] = buf
+        self.buffer_index = 1 - self.buffer_index
+        # the only copy of the frame, no rgbSwapped() on the GUI thread
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=buf)
+        img_h, img_w = buf.shape[:2]
+        return QtGui.QImage(buf.data, img_w, img_h, img_w * 3, QtGui.QImage.Format_RGB888)
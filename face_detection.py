@@ -0,0 +1,123 @@
+import queue
+import threading
+import traceback
+
+import numpy as np
+
+import config_main
+from retina_face_detector.face_detector import RetinaFaceDetector
+
+# run face detection in its own thread so it overlaps with capture and post-processing
+ASYNC = config_main.data['FACE_DETECTION_ASYNC']
+QUEUE_SIZE = 2
+# detect at the smallest scale that still resolves MIN_FACE_SIZE, smaller faces are discarded anyway
+ADAPTIVE_SCALE = config_main.data['FACE_DETECTION_ADAPTIVE_SCALE']
+# smallest face in pixels the model still finds reliably, the smallest anchor of mnet.25 is 16 px
+MODEL_MIN_FACE = config_main.data['FACE_DETECTION_MODEL_MIN_FACE']
+
+
+def detection_scale(min_face_size=None, model_min_face=MODEL_MIN_FACE):
+    """Input scale at which a face of min_face_size pixels becomes model_min_face pixels, never above 1"""
+    if min_face_size is None:
+        min_face_size = config_main.data['MIN_FACE_SIZE']
+    if min_face_size <= 0:
+        return 1.0
+    return min(1.0, float(model_min_face) / min_face_size)
+
+
+class FaceDetector:
+    """RetinaFace fed by a bounded queue, results are tagged with their frame_id like HumanDetector.
+    MXNet releases the GIL while it computes, so a thread is enough here"""
+
+    def __init__(self, gpuid=None, threaded=ASYNC, scale=None):
+        if gpuid is None:
+            gpuid = config_main.data['FACE_DETECTION_GPU']
+        if scale is None:
+            scale = detection_scale() if ADAPTIVE_SCALE else 1.0
+        self.gpuid = gpuid
+        # images are detected at this scale, results are in the coordinates of the images given to put_frame
+        self.scale = scale
+        self.threaded = threaded
+        self.in_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.out_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.stopped = False
+        self.detector = None
+        self.th = None
+        self.error_count = 0
+
+    def start(self):
+        self.detector = RetinaFaceDetector(gpuid=self.gpuid)
+        if self.threaded:
+            self.th = threading.Thread(target=self._run)
+            self.th.daemon = True
+            self.th.start()
+
+    def stop(self):
+        if not self.stopped:
+            self.stopped = True
+            if self.th is not None:
+                try:
+                    self.in_queue.put((None, None), False)
+                except queue.Full:
+                    pass
+                self.th.join()
+                self.th = None
+
+    def warm_up(self, image_sizes, scales=None):
+        """Bind the network to the (height, width) image sizes that will be used, call it before put_frame"""
+        if scales is None:
+            scales = [self.scale]
+        self.detector.warm_up(image_sizes, scales)
+
+    def put_frame(self, frame_id, img):
+        """Send a image to the detection thread, discard the oldest queued image if the queue is full"""
+        if not self.threaded:
+            self._put_result((frame_id,) + self._detect(img))
+            return
+        if self.in_queue.full():
+            try:
+                self.in_queue.get(False)
+            except queue.Empty:
+                pass
+        self.in_queue.put((frame_id, img))
+
+    def get_result(self, block=True):
+        try:
+            return self.out_queue.get(block)
+        except queue.Empty:
+            return None
+
+    def get_results(self):
+        """Return all results that are currently available, oldest first"""
+        results = []
+        while True:
+            res = self.get_result(block=False)
+            if res is None:
+                return results
+            results.append(res)
+
+    def _put_result(self, result):
+        if self.out_queue.full():
+            try:
+                self.out_queue.get(False)
+            except queue.Empty:
+                pass
+        self.out_queue.put(result)
+
+    def _run(self):
+        while not self.stopped:
+            frame_id, img = self.in_queue.get()
+            if frame_id is None:
+                break
+            recs, points = self._detect(img)
+            self._put_result((frame_id, recs, points))
+
+    def _detect(self, img):
+        """Detect faces, a failure gives no face for that frame instead of ending the detection thread"""
+        try:
+            return self.detector.detect(img, scale=self.scale)
+        except Exception as e:
+            self.error_count += 1
+            print('FaceDetector: detection failed', e)
+            traceback.print_exc()
+            return np.zeros((0, 5)), np.zeros((0, 5, 2))
@@ -9,7 +9,6 @@ import urllib.parse
 import cv2
 import numpy as np
 import requests
-from PyQt5 import QtCore
 
 import config_main
 from arcface_embedding.arcface_embedding import ArcfaceEmbedding
@@ -19,18 +18,21 @@ TEMP_DIR = tempfile.gettempdir()
 MAX_FACE = 5
 
 
-class FaceIDManager(QtCore.QObject):
+class FaceIDManager:
     """Query for FaceID and send update to the server. Yes, I should not design this class like this, but I am in hurry, sorry :(("""
     # TODO Re-design this class
-    updateFaceID = QtCore.pyqtSignal(int, np.ndarray, float, int)
 
     def __init__(self):
-        super(FaceIDManager, self).__init__()
+        self.listeners = []
         self.emb_model = ArcfaceEmbedding()
         self.in_queue = queue.Queue(maxsize=500)
         self.stopped = False
         self.th = None
 
+    def add_listener(self, callback):
+        """callback(cid, avatar, timestamp, count) is called from the worker thread for every FaceID"""
+        self.listeners.append(callback)
+
     def start(self):
         self.stopped = False
         self.th = threading.Thread(target=self._run)
@@ -92,7 +94,8 @@ class FaceIDManager(QtCore.QObject):
                     storage.insert_into_visit_data(cid, data['timestamp'])
                     avatar = np.transpose(face_crop[0], (1, 2, 0))
                     avatar = cv2.cvtColor(avatar, cv2.COLOR_RGB2BGR)
-                    self.updateFaceID.emit(cid, avatar, data['timestamp'], count)
+                    for callback in self.listeners:
+                        callback(cid, avatar, data['timestamp'], count)
                     # send customer data to server
                     header = dict()
                     header['Store-Id'] = config_main.data['STORE_ID']
@@ -0,0 +1,100 @@
+"""Choose how many frames per second of a stream go to the detectors."""
+
+import time
+
+import config_main
+
+FRAME_RATE_CONTROL = config_main.data['FRAME_RATE_CONTROL']
+MAX_FPS = config_main.data['FRAME_RATE_MAX']
+MIN_FPS = config_main.data['FRAME_RATE_MIN']
+# motion energy from which the scene counts as busy
+MOTION_ENERGY = config_main.data['FRAME_RATE_MOTION_ENERGY']
+# stay at full rate this long after the last busy frame, customers often stand still for a while
+HOLD_SECONDS = config_main.data['FRAME_RATE_HOLD_SECONDS']
+# frames sent to the detector that have no result yet, more means the detector can not keep up
+MAX_IN_FLIGHT = 2
+# a frame without result after this many seconds was dropped by the detector
+IN_FLIGHT_TIMEOUT = 5.0
+# weight of the newest latency in its moving average
+LATENCY_SMOOTHING = 0.2
+
+
+class FrameRateController:
+    """Full rate while there is motion, MIN_FPS on a quiet scene, never faster than the detector returns results"""
+
+    def __init__(self, enabled=FRAME_RATE_CONTROL, max_fps=MAX_FPS, min_fps=MIN_FPS,
+                 motion_energy=MOTION_ENERGY, hold_seconds=HOLD_SECONDS, max_in_flight=MAX_IN_FLIGHT, clock=time.time):
+        self.enabled = enabled
+        self.max_fps = max_fps
+        self.min_fps = min(min_fps, max_fps)
+        self.motion_energy = motion_energy
+        self.hold_seconds = hold_seconds
+        self.max_in_flight = max(1, max_in_flight)
+        self.clock = clock
+        self.fps = max_fps
+        self.last_busy = None
+        self.last_processed = None
+        self.latency = None
+        # send time of the frames waiting for their result
+        self.in_flight = dict()
+        self.processed = 0
+        self.skipped = 0
+
+    def should_process(self, motion_energy):
+        """Decide for the current frame, count it as skipped if not"""
+        if not self.enabled:
+            self.processed += 1
+            return True
+        now = self.clock()
+        for fid in [fid for fid, sent_time in self.in_flight.items() if now - sent_time > IN_FLIGHT_TIMEOUT]:
+            del self.in_flight[fid]
+        self._update_rate(now, motion_energy)
+        # 10% slack, so frame time jitter does not skip every other frame at full rate
+        if len(self.in_flight) >= self.max_in_flight or \
+                (self.last_processed is not None and now - self.last_processed < 0.9 / self.fps):
+            self.skipped += 1
+            return False
+        self.last_processed = now
+        self.processed += 1
+        return True
+
+    def sent(self, frame_id):
+        """The frame went to the detector"""
+        if self.enabled:
+            self.in_flight[frame_id] = self.clock()
+
+    def done(self, frame_id):
+        """The result of the frame arrived, frames sent before it were dropped by the detector"""
+        sent_time = self.in_flight.pop(frame_id, None)
+        for fid in [fid for fid in self.in_flight if fid < frame_id]:
+            del self.in_flight[fid]
+        if sent_time is None:
+            return
+        latency = self.clock() - sent_time
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+
+    def _update_rate(self, now, motion_energy):
+        if motion_energy >= self.motion_energy:
+            self.last_busy = now
+        if self.last_busy is not None and now - self.last_busy < self.hold_seconds:
+            fps = self.max_fps
+        else:
+            fps = self.min_fps
+        # with max_in_flight frames in the pipeline, results come at most this fast
+        if self.latency is not None and self.latency > 0:
+            fps = min(fps, max(self.min_fps, self.max_in_flight / self.latency))
+        self.fps = fps
+
+    def get_rate(self):
+        return self.fps
+
+    def get_stats(self):
+        stats = dict()
+        stats['fps'] = self.fps
+        stats['processed'] = self.processed
+        stats['skipped'] = self.skipped
+        stats['latency'] = self.latency if self.latency is not None else 0
+        return stats
@@ -0,0 +1,73 @@
+"""Ring of pre-allocated shared memory slots, used to pass frames to a worker process and
+detection results back without pickling the arrays through a multiprocessing.Queue."""
+
+from multiprocessing import Queue, shared_memory
+
+import numpy as np
+
+MAX_RESULTS = 100  # the detection graphs return at most 100 boxes per frame
+RESULT_FIELDS = 6  # left, top, right, bottom, score, class
+
+
+class SharedFrameRing:
+    """Each slot holds one uint8 frame of at most max_height x max_width x channels, followed by
+    room for MAX_RESULTS detection rows. Only the slot index travels through the queues.
+
+    A slot is owned by whoever holds its index: the producer acquires it and writes a frame, the
+    worker reads the frame in place and writes the result to the same slot, and the consumer
+    releases it after reading the result (or whoever drops the frame/result releases it)."""
+
+    def __init__(self, num_slots, max_height, max_width, channels=3):
+        self.num_slots = num_slots
+        self.frame_size = max_height * max_width * channels
+        self.result_size = MAX_RESULTS * RESULT_FIELDS * np.dtype(np.float32).itemsize
+        self.slot_size = self.frame_size + self.result_size
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slot_size * num_slots)
+        self.free_slots = Queue(maxsize=num_slots)
+        for i in range(num_slots):
+            self.free_slots.put(i)
+
+    def acquire(self, timeout=None):
+        """Return the index of a free slot, or None if there is no free slot after timeout seconds"""
+        try:
+            return self.free_slots.get(True, timeout)
+        except Exception:
+            return None
+
+    def release(self, slot):
+        self.free_slots.put(slot)
+
+    def write_frame(self, slot, frame):
+        """Copy a frame into the slot, return its shape. Raise ValueError if the frame is too big"""
+        if frame.size > self.frame_size:
+            raise ValueError('Frame of shape {} does not fit in a slot of {} bytes'.format(
+                frame.shape, self.frame_size))
+        self.get_frame(slot, frame.shape)[...] = frame
+        return frame.shape
+
+    def get_frame(self, slot, shape):
+        """Return the frame in the slot, as a view on the shared memory (no copy)"""
+        size = int(np.prod(shape))
+        offset = slot * self.slot_size
+        return np.ndarray(size, dtype=np.uint8, buffer=self.shm.buf, offset=offset).reshape(shape)
+
+    def write_result(self, slot, rows):
+        """Write detection rows (n x RESULT_FIELDS) into the slot, return the number of rows written"""
+        n = min(len(rows), MAX_RESULTS)
+        if n > 0:
+            self._result_view(slot, n)[...] = np.asarray(rows, dtype=np.float32)[:n]
+        return n
+
+    def get_result(self, slot, n):
+        """Return a copy of the n detection rows in the slot"""
+        return self._result_view(slot, n).copy()
+
+    def _result_view(self, slot, n):
+        offset = slot * self.slot_size + self.frame_size
+        return np.ndarray((n, RESULT_FIELDS), dtype=np.float32, buffer=self.shm.buf, offset=offset)
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
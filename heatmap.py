@@ -1,16 +1,29 @@
+import functools
+
 import cv2
 import numpy as np
 
+import config_main
+
 RATIO = 0.2
+# keep the boxes and draw them on the heatmap only when it is read, for busy scenes read rarely (no display)
+DEFERRED = config_main.data['HEATMAP_DEFERRED']
 
 
 class HeatMap:
-    def __init__(self):
+    def __init__(self, deferred=DEFERRED):
         self.heatmap = None
         self.count = 0
+        self.deferred = deferred
+        # deferred mode: (top, left, kernel rows, kernel cols) -> number of boxes
+        self.pending = dict()
+        # the last get_heatmap() result, the same array is returned until the next update
+        self.normalized = None
+        # changes with every update and reset, to tell a new heatmap from the last one
+        self.version = 0
 
     def update(self, detections, frame_size):
-        # detections: locations of people in the frame, [(left, top, right, bottom), ...]
+        # detections: locations of people in the frame, (n, 4) array or list of (left, top, right, bottom)
         # frame_size: (row, col)
         nrow, ncol = frame_size
         if self.heatmap is None:
@@ -20,35 +33,76 @@ class HeatMap:
             self.count = 0
 
         self.count += 1
+        self.version += 1
+        self.normalized = None
 
         for box in detections:
-            kernel = HeatMap._create_gaussian_kernel(box)
-            krow, kcol = kernel.shape
-            l, t, _, _ = box
-            l = int(l * RATIO)
-            t = int(t * RATIO)
-            # may cause overflow, but very unlikely. For a demo, this is fine
-            self.heatmap[t:t+krow, l:l+kcol] += kernel
+            l, t, r, b = box
+            krow = HeatMap._kernel_size(b - t)
+            kcol = HeatMap._kernel_size(r - l)
+            if krow < 1 or kcol < 1:
+                continue
+            splat = (int(t * RATIO), int(l * RATIO), krow, kcol)
+            if self.deferred:
+                self.pending[splat] = self.pending.get(splat, 0) + 1
+            else:
+                self._splat(*splat, 1)
 
     def get_heatmap(self):
         if self.heatmap is not None and self.count != 0:
-            return self.heatmap / self.count
+            if self.normalized is None:
+                self._render()
+                self.normalized = self.heatmap / self.count
+            return self.normalized
         else:
             return None
 
+    def get_sum(self):
+        """(sum of the splats, number of updates), a copy that later updates do not change"""
+        if self.heatmap is None:
+            return None, self.count
+        self._render()
+        return self.heatmap.copy(), self.count
+
     def reset(self):
         self.heatmap = None
         self.count = 0
+        self.pending = dict()
+        self.normalized = None
+        self.version += 1
+
+    def _render(self):
+        for splat, weight in self.pending.items():
+            self._splat(*splat, weight)
+        self.pending = dict()
+
+    def _splat(self, t, l, krow, kcol, weight):
+        kernel = _gaussian_kernel(krow, kcol)
+        map_row, map_col = self.heatmap.shape
+        # clip at the borders, boxes may go out of the frame
+        t0, l0 = max(t, 0), max(l, 0)
+        t1, l1 = min(t + krow, map_row), min(l + kcol, map_col)
+        if t0 >= t1 or l0 >= l1:
+            return
+        patch = kernel[t0 - t:t1 - t, l0 - l:l1 - l]
+        if weight == 1:
+            self.heatmap[t0:t1, l0:l1] += patch
+        else:
+            self.heatmap[t0:t1, l0:l1] += weight * patch
 
     @staticmethod
-    def _create_gaussian_kernel(box):
-        l, t, r, b = box
-        h_kernel_size = int((r - l) * RATIO)
-        h_kernel_size -= (h_kernel_size + 1) % 2
-        v_kernel_size = int((b - t) * RATIO)
-        v_kernel_size -= (v_kernel_size + 1) % 2
-        h_kernel = cv2.getGaussianKernel(h_kernel_size, 0)
-        v_kernel = cv2.getGaussianKernel(v_kernel_size, 0)
-        kernel = np.matmul(v_kernel, h_kernel.transpose())
-        kernel = kernel / kernel.max()
-        return kernel
+    def _kernel_size(length):
+        # odd number of heatmap pixels
+        size = int(length * RATIO)
+        return size - (size + 1) % 2
+
+
+@functools.lru_cache(maxsize=1024)
+def _gaussian_kernel(v_kernel_size, h_kernel_size):
+    """Splat of a box, boxes of the same size in heatmap pixels share it, do not modify it"""
+    h_kernel = cv2.getGaussianKernel(h_kernel_size, 0)
+    v_kernel = cv2.getGaussianKernel(v_kernel_size, 0)
+    kernel = np.matmul(v_kernel, h_kernel.transpose())
+    kernel = kernel / kernel.max()
+    kernel.setflags(write=False)
+    return kernel
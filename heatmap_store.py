@@ -0,0 +1,230 @@
+"""Heatmaps in fixed minute and hour buckets.
+
+The store is fed with the running sum of a HeatMap (record), the buckets are the differences between records.
+Minutes are kept in memory as prefix sums, any window of the last ROLLING_MINUTES is one subtraction.
+Hours are saved compact on a thread of their own: uint16 levels of the sum with a scale, the count and a small
+pyramid level for thumbnails. Days and months are rolled up from the hours by HeatmapUpdater."""
+
+import collections
+import datetime
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+import config_main
+from storage import DataStorage
+
+# minutes kept in memory for rolling windows
+ROLLING_MINUTES = config_main.data['HEATMAP_ROLLING_MINUTES']
+# pyrDown steps of the thumbnails, each halves the size
+THUMBNAIL_LEVEL = config_main.data['HEATMAP_THUMBNAIL_LEVEL']
+MAX_LEVEL = 65535
+
+
+def pyramid_level(img, level):
+    for _ in range(level):
+        if min(img.shape[:2]) < 2:
+            break
+        img = cv2.pyrDown(img)
+    return img
+
+
+class CompactHeatmap:
+    """Sum of the splats of a bucket as uint16 levels (sum = levels * scale) and the number of updates"""
+
+    def __init__(self, levels, scale, count, thumbnail):
+        self.levels = levels
+        self.scale = scale
+        self.count = count
+        self.thumbnail = thumbnail
+
+    @staticmethod
+    def from_sum(hmap_sum, count, thumbnail_level=THUMBNAIL_LEVEL):
+        peak = float(hmap_sum.max()) if hmap_sum.size > 0 else 0.0
+        scale = peak / MAX_LEVEL if peak > 0 else 1.0
+        levels = np.clip(np.rint(hmap_sum / scale), 0, MAX_LEVEL).astype('uint16')
+        # averaging never goes above the peak, the thumbnail shares the scale
+        thumbnail = pyramid_level(hmap_sum.astype('float32'), thumbnail_level)
+        thumbnail = np.clip(np.rint(thumbnail / scale), 0, MAX_LEVEL).astype('uint16')
+        return CompactHeatmap(levels, scale, count, thumbnail)
+
+    def get_sum(self, thumbnail=False):
+        levels = self.thumbnail if thumbnail else self.levels
+        return levels.astype('float32') * self.scale
+
+    def get_heatmap(self, thumbnail=False):
+        """Mean heatmap of the bucket, like HeatMap.get_heatmap"""
+        if self.count == 0:
+            return None
+        return self.get_sum(thumbnail) / self.count
+
+    def merge(self, other):
+        if other.levels.shape != self.levels.shape:
+            return self
+        return CompactHeatmap.from_sum(self.get_sum() + other.get_sum(), self.count + other.count)
+
+
+class HeatmapStore:
+    """Minute and hour heatmaps of one camera, the hours are saved to the database when they end"""
+
+    def __init__(self, rolling_minutes=ROLLING_MINUTES, save=True):
+        self.rolling_minutes = rolling_minutes
+        self.save = save
+        self.lock = threading.Lock()
+        # minute start (epoch seconds) -> (running sum, running count) at the end of that minute
+        self.minutes = collections.OrderedDict()
+        # prefix before the oldest minute kept
+        self.base = (None, 0)
+        self.total = None
+        self.total_count = 0
+        # last record of the HeatMap
+        self.source_sum = None
+        self.source_count = 0
+        # [key, sum, count] of the hour being filled
+        self.hour = None
+        self.listeners = []
+        # hours to merge with what earlier runs saved and to save, done on save_thread
+        self.saves = queue.Queue()
+        self.save_thread = None
+        # held while an hour is saved and its listeners are called, a listener scanning the saved hours takes it
+        # so every hour it reads is either already queued to it or not saved yet
+        self.saving = threading.Lock()
+
+    def add_listener(self, callback):
+        """callback(key, heatmap, old_heatmap) is called from the save thread once an hour is saved: the mean heatmap
+        of the hour (None without detections) including what earlier runs saved for it, and the one saved before
+        (None for a new hour)"""
+        self.listeners.append(callback)
+
+    def record(self, timestamp, hmap_sum, count):
+        """Take the running sum and count of a HeatMap (HeatMap.get_sum()), what changed since the last record
+        goes to the minute and hour of timestamp"""
+        if hmap_sum is None:
+            return
+        with self.lock:
+            if self.source_sum is not None and self.source_sum.shape == hmap_sum.shape:
+                delta = hmap_sum - self.source_sum
+                delta_count = count - self.source_count
+            else:
+                delta = hmap_sum.copy()
+                delta_count = count
+            self.source_sum = hmap_sum
+            self.source_count = count
+            if self.total is None or self.total.shape != delta.shape:
+                # first record, or the camera resolution changed
+                self.total = np.zeros(delta.shape)
+                self.total_count = 0
+                self.minutes = collections.OrderedDict()
+                self.base = (None, 0)
+            self.total += delta
+            self.total_count += delta_count
+
+            minute = int(timestamp // 60) * 60
+            self.minutes[minute] = (self.total.copy(), self.total_count)
+            while len(self.minutes) > 0 and next(iter(self.minutes)) <= minute - self.rolling_minutes * 60:
+                self.base = self.minutes.popitem(last=False)[1]
+
+            moment = datetime.datetime.fromtimestamp(timestamp)
+            key = (moment.year, moment.month, moment.day, moment.hour)
+            if self.hour is not None and self.hour[0] != key:
+                self._close()
+            if self.hour is None:
+                self.hour = [key, delta.copy(), delta_count]
+            else:
+                self.hour[1] += delta
+                self.hour[2] += delta_count
+
+    def restart(self):
+        """The HeatMap was reset, its next sum starts from zero"""
+        with self.lock:
+            self.source_sum = None
+            self.source_count = 0
+
+    def end_hour(self, key):
+        """The hour key is over, save it now, listeners hear about it even if it had no detection"""
+        with self.lock:
+            if self.hour is not None and self.hour[0] == key:
+                self._close()
+            else:
+                self._queue_save(key, None)
+
+    def close(self):
+        """Save the hour being filled and wait for the saves, at the end of the run"""
+        with self.lock:
+            self._close()
+        self.saves.join()
+
+    def window(self, seconds, end=None):
+        """Mean heatmap of the minutes in (end - seconds, end], end is the last record by default.
+        Only the last rolling_minutes are kept, a longer window is cut"""
+        with self.lock:
+            if len(self.minutes) == 0:
+                return None
+            end_minute = next(reversed(self.minutes)) if end is None else int(end // 60) * 60
+            start_minute = end_minute - int(seconds // 60) * 60
+            last = None
+            first = self.base
+            for minute, prefix in self.minutes.items():
+                if minute <= start_minute:
+                    first = prefix
+                if minute <= end_minute:
+                    last = prefix
+            if last is None:
+                return None
+            hmap_sum, count = last
+            if first[0] is not None:
+                hmap_sum = hmap_sum - first[0]
+                count = count - first[1]
+            if count <= 0:
+                return None
+            return hmap_sum / count
+
+    def _close(self):
+        if self.hour is None:
+            return
+        key, hmap_sum, count = self.hour
+        self.hour = None
+        self._queue_save(key, CompactHeatmap.from_sum(hmap_sum, count))
+
+    def _queue_save(self, key, compact):
+        if self.save_thread is None:
+            self.save_thread = threading.Thread(target=self._save_func)
+            self.save_thread.daemon = True
+            self.save_thread.start()
+        self.saves.put((key, compact))
+
+    def _save_func(self):
+        storage = DataStorage() if self.save else None
+        while True:
+            key, compact = self.saves.get()
+            self.saving.acquire()
+            try:
+                saved = None
+                if storage is not None:
+                    saved = HeatmapStore._load(storage, key)
+                    # a restart within the hour adds to what was saved before
+                    if compact is None:
+                        compact = saved
+                    elif saved is not None:
+                        compact = compact.merge(saved)
+                    if compact is not None:
+                        storage.set_heatmap_bucket('hour', *key, compact.count, compact.scale, compact.levels,
+                                                   compact.thumbnail)
+                heatmap = compact.get_heatmap() if compact is not None else None
+                old_heatmap = saved.get_heatmap() if saved is not None else None
+                for callback in self.listeners:
+                    callback(key, heatmap, old_heatmap)
+            except Exception as e:
+                print('HeatmapStore: save failed', e)
+            self.saving.release()
+            self.saves.task_done()
+
+    @staticmethod
+    def _load(storage, key):
+        rows = storage.get_heatmap_bucket('hour', *key)
+        if len(rows) == 0:
+            return None
+        count, scale, levels, thumbnail = rows[0]
+        return CompactHeatmap(levels, scale, count, thumbnail)
@@ -1,11 +1,15 @@
 import datetime
 import os
+import queue
 import tempfile
 import threading
 import time
+import traceback
 import urllib.parse
+from calendar import monthrange
 
 import cv2
+import numpy as np
 import requests
 
 import config_main
@@ -13,13 +17,25 @@ import utils_main
 from storage import DataStorage
 
 TEMP_DIR = tempfile.gettempdir()
+# days sent when the rollups start on an old database, like the heatmap updates before them
+MIGRATION_DAYS = 31
+# the last hour of a day is saved after midnight, a day is finished once it is saved or after this
+FINISH_GRACE = datetime.timedelta(hours=2)
 
 
 class HeatmapUpdater:
+    """Day and month heatmaps, rolled up as the hours are saved, and their upload.
+
+    A day rollup is the sum of the hour heatmaps of the day, a month rollup the sum of the day heatmaps. They are
+    updated for every hour heatmap saved (hour_saved) and marked dirty, dirty days and months that are over get
+    their heatmap_day / heatmap_month row and are sent to the server."""
 
     def __init__(self):
         self.stopped = True
         self.thread = None
+        self.hours = queue.Queue()
+        # HeatmapStore.saving of the stores watched
+        self.save_locks = []
 
     def start(self):
         if self.thread is not None:
@@ -34,128 +50,206 @@ class HeatmapUpdater:
         self.thread.join()
         self.thread = None
 
+    def watch(self, store):
+        """Roll up the hours a HeatmapStore saves"""
+        store.add_listener(self.hour_saved)
+        self.save_locks.append(store.saving)
+
+    def hour_saved(self, key, heatmap, old_heatmap):
+        """HeatmapStore listener, called from its save thread. The frame of the hour is saved with the hour row"""
+        self.hours.put((key, old_heatmap, heatmap, True))
+
     def _run_func(self):
-        self._create_missing_heatmap()
+        storage = DataStorage()
+        # no hour is saved during the scan, the hours queued before it are in the database already
+        for lock in self.save_locks:
+            lock.acquire()
+        try:
+            queued = self.hours.qsize()
+            scanned = self._add_missing_hours(storage)
+        finally:
+            for lock in self.save_locks:
+                lock.release()
+        for _ in range(queued):
+            key, old_heatmap, heatmap, has_frame = self.hours.get(block=False)
+            if key not in scanned:
+                self._add_hour(storage, key, old_heatmap, heatmap, has_frame)
+        self._finish_dirty(storage)
         now = datetime.datetime.now()
-        last_time = (now.year, now.month, now.day)
+        last_time = (now.year, now.month, now.day, now.hour)
         while self.stopped is False:
             time.sleep(1)
+            changed = self._add_queued_hours(storage)
             now = datetime.datetime.now()
-            curr_time = (now.year, now.month, now.day)
-            if curr_time != last_time:
-                self._create_missing_heatmap()
+            curr_time = (now.year, now.month, now.day, now.hour)
+            # the last hour of a day is saved after midnight, so look again after every change and every hour
+            if changed or curr_time != last_time:
+                self._finish_dirty(storage)
                 last_time = curr_time
+        # the rest is finished at the next start
+        self._add_queued_hours(storage)
 
-    def _create_missing_heatmap(self):
-        storage = DataStorage()
-        header = dict()
-        header['Store-Id'] = config_main.data['STORE_ID']
-        header['Store-Api-Key'] = config_main.data['API_KEY']
-        post_url = urllib.parse.urljoin(config_main.data['API_URL'], 'api/store-batch/heatmap')
-        # daily heatmap
-        this_day = datetime.datetime.now()
-        oneday = datetime.timedelta(days=1)
-        for i in range(1, 32):
-            this_day = this_day - oneday
-            year = this_day.year
-            month = this_day.month
-            day = this_day.day
-            hmap_data = storage.get_heatmap_day(year, month, day)
-            if len(hmap_data) == 0:
-                day_data = storage.get_day_data(year, month, day)
-                if len(day_data) == 0:
+    def _add_queued_hours(self, storage):
+        changed = False
+        while True:
+            try:
+                key, old_heatmap, heatmap, has_frame = self.hours.get(block=False)
+            except queue.Empty:
+                return changed
+            self._add_hour(storage, key, old_heatmap, heatmap, has_frame)
+            changed = True
+
+    def _add_missing_hours(self, storage):
+        """Roll up the hours saved while nobody listened, and the hours of the last MIGRATION_DAYS and the last
+        month of a database from before the rollups. Days and months that already have their heatmap are not sent
+        again. Returns the keys of the hours added"""
+        today = datetime.date.today()
+        first_day = today - datetime.timedelta(days=MIGRATION_DAYS)
+        last_month = (today.replace(day=1) - datetime.timedelta(days=1)).replace(day=1)
+        first_day = min(first_day, last_month)
+        members = dict()
+        for year, month, day, bits in storage.get_rollup_members('day'):
+            members[(year, month, day)] = bits
+        scanned = set()
+        for year, month, day, hour in storage.get_hour_keys():
+            if members.get((year, month, day), 0) & (1 << hour):
+                continue
+            date = datetime.date(year, month, day)
+            if date < first_day:
+                continue
+            rows = storage.get_hour_heatmap(year, month, day, hour)
+            if len(rows) == 0:
+                continue
+            heatmap, has_frame = rows[0]
+            day_dirty = date >= today - datetime.timedelta(days=MIGRATION_DAYS) and \
+                len(storage.get_heatmap_day(year, month, day)) == 0
+            month_dirty = date >= last_month and len(storage.get_heatmap_month(year, month)) == 0
+            self._add_hour(storage, (year, month, day, hour), None, heatmap, bool(has_frame), day_dirty, month_dirty)
+            members[(year, month, day)] = members.get((year, month, day), 0) | (1 << hour)
+            scanned.add((year, month, day, hour))
+        return scanned
+
+    def _add_hour(self, storage, key, old_heatmap, heatmap, has_frame, day_dirty=True, month_dirty=True):
+        year, month, day, hour = key
+        hsum, count, members, frame_day, frame_hour, dirty = HeatmapUpdater._get_rollup(storage, 'day', year, month, day)
+        old_day = hsum / count if count > 0 else None
+        bit = 1 << hour
+        if members & bit and old_heatmap is not None:
+            # the hour was saved again
+            hsum, count = HeatmapUpdater._subtract(hsum, count, old_heatmap)
+        members |= bit
+        hsum, count = HeatmapUpdater._add(hsum, count, heatmap)
+        # the last frame of the day is blended with the day heatmap
+        if has_frame and (frame_hour is None or hour >= frame_hour):
+            frame_day, frame_hour = day, hour
+        storage.set_rollup('day', year, month, day, hsum, count, members, frame_day, frame_hour,
+                           int(dirty or day_dirty))
+        new_day = hsum / count if count > 0 else None
+
+        # the month is the mean of the day heatmaps, swap the old heatmap of the day for the new one
+        msum, mcount, members, mframe_day, mframe_hour, dirty = HeatmapUpdater._get_rollup(storage, 'month', year,
+                                                                                            month, 0)
+        bit = 1 << day
+        if members & bit and old_day is not None:
+            msum, mcount = HeatmapUpdater._subtract(msum, mcount, old_day)
+        if new_day is not None:
+            msum, mcount = HeatmapUpdater._add(msum, mcount, new_day)
+            members |= bit
+        else:
+            members &= ~bit
+        if has_frame and (mframe_day is None or (day, hour) >= (mframe_day, mframe_hour)):
+            mframe_day, mframe_hour = day, hour
+        storage.set_rollup('month', year, month, 0, msum, mcount, members, mframe_day, mframe_hour,
+                           int(dirty or month_dirty))
+
+    @staticmethod
+    def _get_rollup(storage, period, year, month, day):
+        rows = storage.get_rollup(period, year, month, day)
+        if len(rows) == 0:
+            return None, 0, 0, None, None, 0
+        return rows[0]
+
+    @staticmethod
+    def _add(hsum, count, hmap):
+        if hmap is None:
+            return hsum, count
+        if hsum is None:
+            return hmap.astype('float64'), count + 1
+        if hsum.shape != hmap.shape:
+            print('HeatmapUpdater: heatmap size changed, hour skipped')
+            return hsum, count
+        return hsum + hmap, count + 1
+
+    @staticmethod
+    def _subtract(hsum, count, hmap):
+        if hsum is None or hsum.shape != hmap.shape:
+            return hsum, count
+        if count <= 1:
+            return None, 0
+        return hsum - hmap, count - 1
+
+    def _finish_dirty(self, storage):
+        """Save and send the dirty days and months that are over"""
+        now = datetime.datetime.now()
+        for period, year, month, day in storage.get_dirty_rollups():
+            if period == 'day':
+                if not HeatmapUpdater._day_over(storage, year, month, day, now):
                     continue
-                hmap = None
-                count = 0
-                for row in day_data:
-                    if row[-2] is not None:
-                        if hmap is None:
-                            hmap = row[-2]
-                            count += 1
-                        else:
-                            hmap += row[-2]
-                            count += 1
-                if count != 0 and hmap is not None:
-                    hmap = hmap / count
-                    storage.set_heatmap_day(year, month, day, hmap)
-                    hmap_min = hmap.min()
-                    hmap_max = hmap.max()
-                    hmap = (hmap - hmap_min) / (hmap_max - hmap_min)
-                    frame = day_data[-1][-1]
-                    send_img = utils_main.blend_heatmap(frame, hmap, 1)
-                    filename = os.path.join(TEMP_DIR, 'heatmap_day.jpg')
-                    cv2.imwrite(filename, send_img)
-                    data_to_send = dict()
-                    data_to_send['year'] = year
-                    data_to_send['month'] = month
-                    data_to_send['day'] = day
-                    with open(filename, 'rb') as fi:
-                        files = {'heatmap_img': fi}
-                        r = requests.post(post_url, data=data_to_send, headers=header, files=files, timeout=30)
-                        if r.status_code >= 300:
-                            print('Send heatmap to server. Error code:', r.status_code)
-                        else:
-                            print('Send heatmap to server: Done. Status code:', r.status_code)
-                else:
-                    storage.set_heatmap_day(year, month, day, None)
-        # monthly heatmap
-        this_day = datetime.datetime.now()
-        year = this_day.year
-        month = this_day.month
-        month -= 1
-        if month == 0:
-            month = 12
-            year -= 1
-        hmap_data = storage.get_heatmap_month(year, month)
-        if len(hmap_data) == 0:
-            month_data = storage.get_month_statistic(year, month)
-            if len(month_data) != 0:
-                count = 0
-                hmap = None
-                for row in month_data:
-                    day = row[0]
-                    day_hmap = storage.get_heatmap_day(year, month, day)
-                    if len(day_hmap) > 0 and day_hmap[0][0] is not None:
-                        day_hmap = day_hmap[0][0]
-                        if hmap is None:
-                            hmap = day_hmap
-                            count += 1
-                        else:
-                            hmap += day_hmap
-                            count += 1
-                if count != 0 and hmap is not None:
-                    hmap = hmap / count
-                    storage.set_heatmap_month(year, month, hmap)
-                    hmap_min = hmap.min()
-                    hmap_max = hmap.max()
-                    hmap = (hmap - hmap_min) / (hmap_max - hmap_min)
-                    # find a frame to blend with heatmap
-                    frame = None
-                    for i in range(1, 32):
-                        this_day = this_day - oneday
-                        year_ = this_day.year
-                        month_ = this_day.month
-                        day_ = this_day.day
-                        day_data = storage.get_day_data(year_, month_, day_)
-                        for row in day_data:
-                            if row[-1] is not None:
-                                frame = row[-1]
-                                break
-                        if frame is not None:
-                            break
-                    if frame is not None:
-                        send_img = utils_main.blend_heatmap(frame, hmap, 1)
-                        filename = os.path.join(TEMP_DIR, 'heatmap_month.jpg')
-                        cv2.imwrite(filename, send_img)
-                        data_to_send = dict()
-                        data_to_send['year'] = year
-                        data_to_send['month'] = month
-                        with open(filename, 'rb') as fi:
-                            files = {'heatmap_img': fi}
-                            r = requests.post(post_url, data=data_to_send, headers=header, files=files, timeout=30)
-                            if r.status_code >= 300:
-                                print('Send heatmap to server. Error code:', r.status_code)
-                            else:
-                                print('Send heatmap to server: Done. Status code:', r.status_code)
+            elif not HeatmapUpdater._day_over(storage, year, month, monthrange(year, month)[1], now):
+                continue
+            hsum, count, _, frame_day, frame_hour, _ = HeatmapUpdater._get_rollup(storage, period, year, month, day)
+            hmap = hsum / count if count > 0 and hsum is not None else None
+            if period == 'day':
+                storage.set_heatmap_day(year, month, day, hmap)
+            else:
+                storage.set_heatmap_month(year, month, hmap)
+            storage.set_rollup_clean(period, year, month, day)
+            if hmap is None:
+                continue
+            # the one frame needed, the hour row may not be written yet or have no frame
+            frame = storage.get_hour_frame(year, month, frame_day, frame_hour) if frame_hour is not None else []
+            if len(frame) == 0 or frame[0][0] is None:
+                frame = storage.get_last_frame(year, month, day if period == 'day' else None)
+            if len(frame) == 0:
+                continue
+            data_to_send = dict()
+            data_to_send['year'] = year
+            data_to_send['month'] = month
+            if period == 'day':
+                data_to_send['day'] = day
+            HeatmapUpdater._send(hmap, frame[0][0], data_to_send, 'heatmap_{}.jpg'.format(period))
+
+    @staticmethod
+    def _day_over(storage, year, month, day, now):
+        """The day has ended and its last hour is saved, or is late by more than FINISH_GRACE"""
+        end = datetime.datetime(year, month, day) + datetime.timedelta(days=1)
+        if now >= end + FINISH_GRACE:
+            return True
+        if now < end:
+            return False
+        members = HeatmapUpdater._get_rollup(storage, 'day', year, month, day)[2]
+        return bool(members & (1 << 23))
+
+    @staticmethod
+    def _send(hmap, frame, data_to_send, name):
+        try:
+            header = dict()
+            header['Store-Id'] = config_main.data['STORE_ID']
+            header['Store-Api-Key'] = config_main.data['API_KEY']
+            post_url = urllib.parse.urljoin(config_main.data['API_URL'], 'api/store-batch/heatmap')
+            hmap_min = hmap.min()
+            hmap_max = hmap.max()
+            hmap = (hmap - hmap_min) / max(hmap_max - hmap_min, np.finfo('float32').eps)
+            send_img = utils_main.blend_heatmap(frame, hmap, 1)
+            filename = os.path.join(TEMP_DIR, name)
+            cv2.imwrite(filename, send_img)
+            with open(filename, 'rb') as fi:
+                files = {'heatmap_img': fi}
+                r = requests.post(post_url, data=data_to_send, headers=header, files=files, timeout=30)
+                if r.status_code >= 300:
+                    print('Send heatmap to server. Error code:', r.status_code)
                 else:
-                    storage.set_heatmap_month(year, month, None)
+                    print('Send heatmap to server: Done. Status code:', r.status_code)
+        except Exception as e:
+            print(e)
+            traceback.print_exc()
@@ -1,159 +1,278 @@
 import os
-from ctypes import c_bool
+import queue
+import time
+from ctypes import c_bool, c_double, c_long
 from multiprocessing import Process, Queue, Value
 
 import numpy as np
-import tensorflow as tf
 
 import config_main
 import utils_main
+from detector_backend import create_human_backend
+from frame_ring import SharedFrameRing
 
-MODEL_NAME = config_main.data['DETECTION_MODEL']
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
-PATH_TO_CKPT = os.path.join(THIS_DIR, 'data_main',
-                            MODEL_NAME, 'frozen_inference_graph.pb')
 PATH_TO_LABELS = os.path.join(
     THIS_DIR, 'data_main', config_main.data['DETECTION_MAP_FILE'])
 
 NUM_CLASSES = config_main.data['NUM_CLASSES']
 THRESHOLD = config_main.data['DETECTION_THRESHOLD']
 OVERLAP_THRESHOLD = config_main.data['DETECTION_OVERLAP_THRESHOLD']
+# batched inference: run up to BATCH_SIZE frames in one forward pass, wait at most BATCH_TIMEOUT_MS for them
+BATCH_SIZE = config_main.data['DETECTION_BATCH_SIZE']
+BATCH_TIMEOUT_MS = config_main.data['DETECTION_BATCH_TIMEOUT_MS']
+# pass frames and results through shared memory instead of pickling them
+SHARED_MEMORY = config_main.data['DETECTION_SHARED_MEMORY']
 
 KEEP_CLASSES = {'person'}
 
 
+def create_counters():
+    """Shared counters updated by the detection processes: frames, batches, busy time, sum of latencies"""
+    return Value(c_long, 0), Value(c_long, 0), Value(c_double, 0.0), Value(c_double, 0.0)
+
+
+def throughput_stats(counters, start_time):
+    """Return counters to tune the batch size against latency"""
+    frame_count, batch_count, busy_time, latency_sum = counters
+    frames = frame_count.value
+    batches = batch_count.value
+    stats = dict()
+    stats['frames'] = frames
+    stats['batches'] = batches
+    stats['avg_batch_size'] = frames / batches if batches > 0 else 0
+    # frames per second of pure inference time (of one worker), and of wall clock time since start
+    stats['inference_fps'] = frames / busy_time.value if busy_time.value > 0 else 0
+    if start_time is not None and frames > 0:
+        stats['fps'] = frames / (time.time() - start_time)
+    else:
+        stats['fps'] = 0
+    # from put_frame to the result being ready, in seconds
+    stats['avg_latency'] = latency_sum.value / frames if frames > 0 else 0
+    return stats
+
+
 class HumanDetector:
 
-    def __init__(self):
-        self.in_queue = Queue(maxsize=1)
-        self.out_queue = Queue(maxsize=1)
+    def __init__(self, batch_size=BATCH_SIZE, batch_timeout_ms=BATCH_TIMEOUT_MS, shared_memory=SHARED_MEMORY,
+                 backend=None):
+        # name of the detection engine, see detector_backend.HUMAN_BACKENDS
+        self.backend = backend if backend is not None else config_main.data['DETECTION_BACKEND']
+        self.batch_size = max(1, batch_size)
+        self.batch_timeout = batch_timeout_ms / 1000.0
+        self.in_queue = Queue(maxsize=self.batch_size)
+        self.out_queue = Queue(maxsize=self.batch_size)
+        if shared_memory:
+            # enough slots for a full input queue, a batch in progress and a full output queue
+            self.ring = SharedFrameRing(3 * self.batch_size + 1,
+                                        config_main.data['PROCESS_HEIGHT'], config_main.data['PROCESS_WIDTH'])
+        else:
+            self.ring = None
         self.stopped = Value(c_bool, False)
+        # throughput counters, updated by the detection process
+        self.counters = create_counters()
+        self.start_time = None
+        # frames not sent for lack of a free slot, or too big for one
+        self.dropped = 0
+        # a frame too big for the ring was reported
+        self.oversized = False
 
     @staticmethod
-    def _run_function(in_queue, out_queue, stopped):
-        if config_main.data['HUMAN_DETECTION_GPU'] < 0:
-            device = '/device:CPU:0'
-            my_devices = tf.config.experimental.list_physical_devices(device_type='CPU')
-            tf.config.experimental.set_visible_devices(devices=my_devices, device_type='CPU')
-            config = tf.ConfigProto(device_count={'GPU': 0})
-        else:
-            device = '/GPU:' + str(config_main.data['HUMAN_DETECTION_GPU'])
-            os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'true'
-            config = tf.ConfigProto()
-            config.gpu_options.allow_growth = True
-        with tf.device(device):
-            detection_graph = tf.Graph()
-            with detection_graph.as_default():
-                od_graph_def = tf.GraphDef()
-                with tf.gfile.GFile(PATH_TO_CKPT, 'rb') as fid:
-                    serialized_graph = fid.read()
-                    od_graph_def.ParseFromString(serialized_graph)
-                    tf.import_graph_def(od_graph_def, name='')
-
-            label_map = utils_main.load_labelmap(PATH_TO_LABELS)
-            categories = utils_main.convert_label_map_to_categories(
-                label_map, max_num_classes=NUM_CLASSES, use_display_name=True)
-            category_index = utils_main.create_category_index(categories)
-
-            with detection_graph.as_default():
-                with tf.Session(graph=detection_graph, config=config) as sess:
-                    # Get input and output tensors
-                    image_tensor = detection_graph.get_tensor_by_name(
-                        'image_tensor:0')
-                    boxes = detection_graph.get_tensor_by_name(
-                        'detection_boxes:0')
-                    scores = detection_graph.get_tensor_by_name(
-                        'detection_scores:0')
-                    classes = detection_graph.get_tensor_by_name(
-                        'detection_classes:0')
-                    num_detections = detection_graph.get_tensor_by_name(
-                        'num_detections:0')
-
-                    while not stopped.value:
-                        fid, frame = in_queue.get()
-                        if fid is None:
-                            break
-
-                        image_np_expanded = np.expand_dims(frame, axis=0)
-
-                        # Actual detection.
-                        (boxes_res, scores_res, classes_res, num_detections_res) = sess.run(
-                            [boxes, scores, classes, num_detections],
-                            feed_dict={image_tensor: image_np_expanded})
-
-                        # post-processing of detection output
-                        boxes_res = np.squeeze(boxes_res)
-                        scores_res = np.squeeze(scores_res)
-                        classes_res = np.squeeze(classes_res)
-
-                        im_height, im_width = frame.shape[:2]
-
-                        # Output will be stored in these lists
-                        output_scores = []
-                        output_cls = []
-                        output_boxes = []
-
-                        for i, score in enumerate(scores_res):
-                            # Stop when score is lower than threshold since the
-                            # score is sorted.
-                            if score < THRESHOLD:
-                                break
-                            class_name = category_index[classes_res[i]]['name']
-
-                            if class_name not in KEEP_CLASSES:
-                                continue
-
-                            ymin, xmin, ymax, xmax = boxes_res[i]
-                            (left, right, top, bottom) = (xmin * im_width, xmax * im_width,
-                                                          ymin * im_height, ymax * im_height)
-
-                            if utils_main.any_overlap((left, top, right, bottom), output_boxes, OVERLAP_THRESHOLD):
-                                continue
-
-                            # Append the detections to list
-                            output_scores.append(score)
-                            output_cls.append(class_name)
-                            output_boxes.append((left, top, right, bottom))
-                        try:
-                            out_queue.get(False)
-                        except Exception:
-                            pass
-                        out_queue.put(
-                            (fid, output_scores, output_cls, output_boxes))
+    def _run_function(in_queue, out_queue, stopped, batch_size, batch_timeout, counters, ring, backend_name):
+        frame_count, batch_count, busy_time, latency_sum = counters
+        # the backend loads its model here, in the detection process
+        backend = create_human_backend(backend_name)
+        backend.load()
+
+        label_map = utils_main.load_labelmap(PATH_TO_LABELS)
+        categories = utils_main.convert_label_map_to_categories(
+            label_map, max_num_classes=NUM_CLASSES, use_display_name=True)
+        category_index = utils_main.create_category_index(categories)
+        keep_class_ids = np.array([cid for cid, cat in category_index.items()
+                                   if cat['name'] in KEEP_CLASSES], dtype=np.int32)
+
+        while not stopped.value:
+            batch, stop = HumanDetector._collect_batch(in_queue, batch_size, batch_timeout)
+            start = time.time()
+            # in shared memory mode the frames are read in place from the ring
+            if ring is not None:
+                frames = [ring.get_frame(*payload) for _, payload, _ in batch]
+            else:
+                frames = [payload for _, payload, _ in batch]
+            # frames in one batch must have the same size
+            groups = dict()
+            for i, frame in enumerate(frames):
+                groups.setdefault(frame.shape, []).append(i)
+            for group in groups.values():
+                # Actual detection.
+                raw_results = backend.detect_batch([frames[i] for i in group])
+
+                now = time.time()
+                for (boxes_res, scores_res, classes_res), i in zip(raw_results, group):
+                    fid, payload, put_time = batch[i]
+                    im_height, im_width = frames[i].shape[:2]
+                    result = HumanDetector._post_process(
+                        boxes_res, scores_res, classes_res,
+                        im_height, im_width, keep_class_ids)
+                    if ring is not None:
+                        # the result goes back in the slot of its frame
+                        slot = payload[0]
+                        n = ring.write_result(slot, HumanDetector._encode_result(*result))
+                        HumanDetector._put_result(out_queue, (fid, slot, n), ring)
+                    else:
+                        HumanDetector._put_result(out_queue, (fid,) + result)
+                    with latency_sum.get_lock():
+                        latency_sum.value += now - put_time
+            if len(batch) > 0:
+                with frame_count.get_lock():
+                    frame_count.value += len(batch)
+                with batch_count.get_lock():
+                    batch_count.value += 1
+                with busy_time.get_lock():
+                    busy_time.value += time.time() - start
+            if stop:
+                break
+        backend.close()
+
+    @staticmethod
+    def _collect_batch(in_queue, batch_size, batch_timeout):
+        """Wait for one frame, then keep collecting until the batch is full or the timeout expires.
+        Return the list of (frame_id, frame, put_time) and a flag telling the worker to stop"""
+        batch = []
+        fid, frame, put_time = in_queue.get()
+        if fid is None:
+            return batch, True
+        batch.append((fid, frame, put_time))
+        deadline = time.time() + batch_timeout
+        while len(batch) < batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                fid, frame, put_time = in_queue.get(True, remaining)
+            except queue.Empty:
+                break
+            if fid is None:
+                return batch, True
+            batch.append((fid, frame, put_time))
+        return batch, False
+
+    @staticmethod
+    def _post_process(boxes_res, scores_res, classes_res, im_height, im_width, keep_class_ids):
+        """Filter the raw output of one frame.
+        Return arrays of scores (n,), class ids (n,) and boxes (n, 4) as (left, top, right, bottom)"""
+        classes_res = classes_res.astype(np.int32)
+        mask = (scores_res >= THRESHOLD) & np.isin(classes_res, keep_class_ids)
+        # the graph gives (ymin, xmin, ymax, xmax) in relative coordinates
+        output_boxes = boxes_res[mask][:, [1, 0, 3, 2]] * np.array(
+            [im_width, im_height, im_width, im_height], dtype=np.float32)
+        # scores are sorted, so this keeps the same boxes as checking any_overlap one by one
+        keep = utils_main.suppress_overlaps(output_boxes, OVERLAP_THRESHOLD)
+        output_scores = scores_res[mask][keep].astype(np.float32)
+        output_cls = classes_res[mask][keep]
+        output_boxes = output_boxes[keep].astype(np.float32)
+        return output_scores, output_cls, output_boxes
+
+    @staticmethod
+    def _put_result(out_queue, result, ring=None):
+        """Put a result to the output queue, drop the oldest result if nobody picked it up"""
+        if out_queue.full():
+            try:
+                dropped = out_queue.get(False)
+                if ring is not None:
+                    ring.release(dropped[1])
+            except Exception:
+                pass
+        out_queue.put(result)
+
+    @staticmethod
+    def _encode_result(output_scores, output_cls, output_boxes):
+        """Pack a result into rows of (left, top, right, bottom, score, class) for the shared memory ring"""
+        return np.hstack((output_boxes, output_scores[:, None], output_cls[:, None]))
+
+    @staticmethod
+    def _decode_result(rows):
+        return rows[:, 4], rows[:, 5].astype(np.int32), rows[:, :4]
 
     def start(self):
         # we need to run detector in another process to avoid Python's Global Interpreter Lock
         self.process = Process(target=HumanDetector._run_function,
-                               args=(self.in_queue, self.out_queue, self.stopped))
+                               args=(self.in_queue, self.out_queue, self.stopped,
+                                     self.batch_size, self.batch_timeout, self.counters, self.ring, self.backend))
         self.process.daemon = True
         self.process.start()
+        self.start_time = time.time()
 
     def stop(self):
         if not self.stopped.value:
             self.stopped.value = True
             try:
-                self.in_queue.put((None, None), False)
+                self.in_queue.put((None, None, None), False)
             except Exception:
                 pass
             self.process.join()
+            if self.ring is not None:
+                self.ring.close()
+                self.ring.unlink()
 
     def put_frame(self, frame_id, img):
-        """Send a image to the detection process"""
-        try:
-            self.in_queue.get(False)
-        except Exception:
-            pass
-        self.in_queue.put((frame_id, img))
+        """Send a image to the detection process, discard the oldest queued image if the queue is full.
+        Return False if the image was dropped, it will have no result"""
+        if self.in_queue.full():
+            try:
+                dropped = self.in_queue.get(False)
+                if self.ring is not None:
+                    self.ring.release(dropped[1][0])
+            except Exception:
+                pass
+        if self.ring is not None:
+            # only the slot index and the frame shape cross the queue
+            slot = self.ring.acquire(timeout=1.0)
+            if slot is None:
+                self.dropped += 1
+                return False
+            try:
+                shape = self.ring.write_frame(slot, img)
+            except ValueError as e:
+                self.ring.release(slot)
+                if not self.oversized:
+                    print('HumanDetector:', e)
+                    self.oversized = True
+                self.dropped += 1
+                return False
+            self.in_queue.put((frame_id, (slot, shape), time.time()))
+        else:
+            self.in_queue.put((frame_id, img, time.time()))
+        return True
 
     def get_result(self, block=True):
         if block:
-            return self.out_queue.get()
+            res = self.out_queue.get()
         else:
             try:
                 res = self.out_queue.get(False)
             except Exception:
                 return None
-            return res
+        if self.ring is not None:
+            fid, slot, n = res
+            rows = self.ring.get_result(slot, n)
+            self.ring.release(slot)
+            res = (fid,) + HumanDetector._decode_result(rows)
+        return res
+
+    def get_results(self):
+        """Return all results that are currently available, oldest first"""
+        results = []
+        while True:
+            res = self.get_result(block=False)
+            if res is None:
+                return results
+            results.append(res)
+
+    def get_throughput(self):
+        stats = throughput_stats(self.counters, self.start_time)
+        stats['dropped'] = self.dropped
+        return stats
 
     def warm_up(self):
         """Feed a empty image through the network to warm it up"""
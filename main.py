@@ -1,10 +1,7 @@
 import datetime
 import os
-import pickle
-import random
 import sys
 import tempfile
-import time
 from calendar import monthrange
 
 import cv2
@@ -12,30 +9,11 @@ import numpy as np
 import xlsxwriter
 from PyQt5 import QtChart, QtCore, QtGui, QtWidgets, uic
 
-import config_main
 import utils_main
-from face_age_gender.age_gender_estimator import AgeGenderEstimator
-from faceid import FaceIDManager
-from heatmap import HeatMap
-from heatmap_updater import HeatmapUpdater
-from human_detection import HumanDetector
+from display import DisplayWorker
 from mark_payment_area import MarkAreaWindow
-from motion_detection import MotionDetection
-from retina_face_detector.face_detector import RetinaFaceDetector
+from pipeline import Engine
 from storage import DataStorage
-from storage_update import StorageUpdater
-# from tracker_2 import Tracker
-from tracker_3 import SimpleTracker
-from videostream import QueuedStream
-
-# from wait_time_estimate import WaitTimeEstimator
-
-# Do not run performance tests to find the best convolution algorithm
-os.environ["MXNET_CUDNN_AUTOTUNE_DEFAULT"] = "0"
-
-storage_updater = StorageUpdater()
-heatmap_updater = HeatmapUpdater()
-heatmap_updater.start()
 
 
 class MainWindow(QtWidgets.QWidget):
@@ -44,16 +22,22 @@ class MainWindow(QtWidgets.QWidget):
         uifile = os.path.join(os.path.dirname(
             os.path.realpath(__file__)), 'main.ui')
         uic.loadUi(uifile, self)
-        self.frame = None
-        self.face_frame = None
-        self.heatmap = None
         self.storage = DataStorage()
-        self.human_process = HumanProcess()
-        self.human_process.updateFrame.connect(self.updateFrame)
-        self.human_process.updateHeatmap.connect(self.updateHeatmap)
+        # the pipelines, storage and uploads, the window only shows what they produce
+        self.engine = Engine()
+        # frames are converted and blended on their own threads, at most once per screen refresh
+        screen = QtGui.QGuiApplication.primaryScreen()
+        refresh_rate = screen.refreshRate() if screen is not None and screen.refreshRate() > 0 else 60.0
+        self.camera_display = DisplayWorker(refresh_rate)
+        self.camera_display.updateImage.connect(self.updateCameraImage)
+        self.engine.human.add_frame_listener(self.camera_display.put_frame)
+        self.engine.human.add_heatmap_listener(self.camera_display.set_heatmap)
+        self.face_display = DisplayWorker(refresh_rate)
+        self.face_display.updateImage.connect(self.updateFaceImage)
+        self.engine.face.add_frame_listener(self.face_display.put_frame)
+        self.human_process = HumanProcess(self.engine.human)
         self.human_process.finished.connect(self.human_process_finished)
-        self.face_process = FaceProcess()
-        self.face_process.updateFrame.connect(self.updateFaceFrame)
+        self.face_process = FaceProcess(self.engine.face)
         self.face_process.finished.connect(self.face_process_finished)
         self.face_process.updateFaceID.connect(self.updateFaceID)
         self.camera_video_label.setText('No information')
@@ -61,6 +45,10 @@ class MainWindow(QtWidgets.QWidget):
 
         self.day_calendar_widget.selectionChanged.connect(self.load_day_data)
         self.tabWidget.currentChanged.connect(self.changedTab)
+        self.camera_heatmap_checkBox.toggled.connect(self._set_heatmap_options)
+        self.camera_heatmap_slider.valueChanged.connect(self._set_heatmap_options)
+        self._set_heatmap_options()
+        self._set_display_visible(self.tabWidget.currentIndex())
 
         self.month_comboBox.currentIndexChanged.connect(self.load_month_data)
         self.year_comboBox.currentIndexChanged.connect(self.load_month_data)
@@ -76,26 +64,15 @@ class MainWindow(QtWidgets.QWidget):
         self.stop()
         event.accept()
 
-    @QtCore.pyqtSlot(np.ndarray)
-    def updateFrame(self, frame):
-        self.frame = frame
-        if self.tabWidget.currentIndex() == 0:
-            self._set_video_frame()
-            self.update()
-
-    @QtCore.pyqtSlot(np.ndarray)
-    def updateFaceFrame(self, frame):
-        self.face_frame = frame
-        if self.tabWidget.currentIndex() == 1:
-            img_h, img_w = self.face_frame.shape[:2]
-            qimg = QtGui.QImage(self.face_frame, img_w, img_h, img_w * 3,
-                                QtGui.QImage.Format_RGB888).rgbSwapped()
-            self.face_video_label.setPixmap(QtGui.QPixmap(qimg))
-            self.update()
-
-    @QtCore.pyqtSlot(np.ndarray)
-    def updateHeatmap(self, hmap):
-        self.heatmap = hmap
+    @QtCore.pyqtSlot(QtGui.QImage)
+    def updateCameraImage(self, image):
+        self.camera_video_label.setPixmap(QtGui.QPixmap.fromImage(image))
+        self.camera_display.drawn()
+
+    @QtCore.pyqtSlot(QtGui.QImage)
+    def updateFaceImage(self, image):
+        self.face_video_label.setPixmap(QtGui.QPixmap.fromImage(image))
+        self.face_display.drawn()
 
     @QtCore.pyqtSlot()
     def human_process_finished(self):
@@ -110,6 +87,10 @@ class MainWindow(QtWidgets.QWidget):
         self.update()
 
     def start(self):
+        # the pipelines run on the Qt threads
+        self.engine.start(threaded=False)
+        self.camera_display.start()
+        self.face_display.start()
         self.human_process.start()
         self.face_process.start()
 
@@ -118,22 +99,20 @@ class MainWindow(QtWidgets.QWidget):
         self.human_process.wait()
         self.face_process.stop()
         self.face_process.wait()
-        self.frame = None
-        self.heatmap = None
-        storage_updater.flush()
-        heatmap_updater.stop()
-
-    def _set_video_frame(self):
-        img_h, img_w = self.frame.shape[:2]
-        if self.camera_heatmap_checkBox.isChecked() and self.heatmap is not None:
-            power = self.camera_heatmap_slider.value()
-            power = (21 - power) / 11
-            out = utils_main.blend_heatmap(self.frame, self.heatmap, power)
-        else:
-            out = self.frame
-        qimg = QtGui.QImage(out, img_w, img_h, img_w * 3,
-                            QtGui.QImage.Format_RGB888).rgbSwapped()
-        self.camera_video_label.setPixmap(QtGui.QPixmap(qimg))
+        self.camera_display.stop()
+        self.face_display.stop()
+        self.engine.stop()
+
+    @QtCore.pyqtSlot()
+    def _set_heatmap_options(self):
+        power = self.camera_heatmap_slider.value()
+        power = (21 - power) / 11
+        self.camera_display.set_heatmap_options(self.camera_heatmap_checkBox.isChecked(), power)
+
+    def _set_display_visible(self, index):
+        # the frames of a hidden tab are not converted
+        self.camera_display.set_visible(index == 0)
+        self.face_display.set_visible(index == 1)
 
     @QtCore.pyqtSlot()
     def load_day_data(self):
@@ -142,6 +121,8 @@ class MainWindow(QtWidgets.QWidget):
         month = selected_date.month()
         day = selected_date.day()
         data = self.storage.get_day_data(year, month, day)
+        # the small heatmaps are plenty for the label, hours saved before the buckets have theirs in the row
+        heatmaps = self.storage.get_heatmap_hours(year, month, day)
         if len(data) == 0:
             self.day_statistic_label.setText('No information')
             self.day_chart_view.setChart(QtChart.QChart())
@@ -165,7 +146,7 @@ class MainWindow(QtWidgets.QWidget):
                 counts[h] = c
                 wait_time[h] = w
                 stay_time[h] = s
-                self.heatmap_hour[h] = row[13]
+                self.heatmap_hour[h] = heatmaps.get(h, row[13])
                 self.frame_hour[h] = row[14]
                 total_count += c
                 total_wait_time += c * w
@@ -234,6 +215,7 @@ class MainWindow(QtWidgets.QWidget):
 
     @QtCore.pyqtSlot(int)
     def changedTab(self, index):
+        self._set_display_visible(index)
         if index == 2:
             self.load_day_data()
         elif index == 3:
@@ -511,7 +493,7 @@ class MainWindow(QtWidgets.QWidget):
     def on_pick_area_button_clicked(self):
         # we should NOT access human_process's attribute this way, but I am in hurry ;( TODO
         area_window = MarkAreaWindow(
-            self.frame, self.human_process.payment_area, self)
+            self.camera_display.frame, self.human_process.payment_area, self)
         area_window.update_list_points.connect(
             self.human_process.set_payment_area)
         area_window.open()
@@ -534,311 +516,41 @@ class MainWindow(QtWidgets.QWidget):
 
 
 class HumanProcess(QtCore.QThread):
-    updateFrame = QtCore.pyqtSignal(np.ndarray)
-    updateHeatmap = QtCore.pyqtSignal(np.ndarray)
+    """Runs the people pipeline on a Qt thread, its frames and heatmap go to a DisplayWorker"""
 
-    def __init__(self):
+    def __init__(self, pipeline):
         super(HumanProcess, self).__init__()
-        self.stopped = False
-        self.payment_area = []
-        path = os.path.join(config_main.DATABASE_DIR, 'payment_area.pkl')
-        if os.path.exists(path):
-            with open(path, 'rb') as fi:
-                self.payment_area = pickle.load(fi)
+        self.pipeline = pipeline
+
+    @property
+    def payment_area(self):
+        return self.pipeline.payment_area
 
     def run(self):
-        video_uri = config_main.data['VIDEO_URI']
-        # object detector, that run on a different process
-        if config_main.data['HUMAN_DETECTION'] is True:
-            human_detector = HumanDetector()
-            human_detector.start()
-        else:
-            human_detector = None
-        # motion detection, we need this to save computing power when the scene is static
-        motion_detector = MotionDetection()
-        # heatmap
-        heatmap = HeatMap()
-        # tracker
-        # tracker = Tracker()
-        # wait time estimator
-        # wait_time_estimator = WaitTimeEstimator()
-        # video stream object, that run on a different thread
-        video = QueuedStream(video_uri, True, 25)
-        video.start()
-        if not video.isOpened():
-            print("Can not open video")
-            return
-        # read some config
-        max_process_w = config_main.data['PROCESS_WIDTH']
-        max_process_h = config_main.data['PROCESS_HEIGHT']
-        max_display_w = config_main.data['DISPLAY_WIDTH']
-        max_display_h = config_main.data['DISPLAY_HEIGHT']
-        #
-        now = datetime.datetime.now()
-        last_time = (now.year, now.month, now.day, now.hour)
-        last_heatmap = None
-        last_heatmap_count = 0
-        # processing loop
-        while not self.stopped:
-            ret, frame, frame_id = video.read()
-            # time_stamp = time.time()
-            if not ret:
-                break
-
-            frame_process = utils_main.resize_max_size(
-                frame, max_process_w, max_process_h)
-
-            # scale_row = frame.shape[0] / frame_process.shape[0]
-            # scale_col = frame.shape[1] / frame_process.shape[1]
-
-            if len(motion_detector.get_motion_region(frame_process)) > 0:
-                # put the current frame to the tracking list
-                # tracker.update_frame(frame_id, time_stamp, frame)
-                # put the current frame to the detection queue, discard all other frames that are currently in the queue
-                if config_main.data['HUMAN_DETECTION'] is True:
-                    human_detector.put_frame(frame_id, frame_process)
-                    # get detection result of the old frame if result is available
-                    # detection_result = human_detector.get_result(block=False)
-                    detection_result = human_detector.get_result(block=False)
-                else:
-                    detection_result = None
-                if detection_result is not None:
-                    frame_id, _, _, boxes = detection_result
-                    # update heatmap
-                    heatmap.update(boxes, frame_process.shape[:2])
-                    # update tracker
-                    # boxes_correct_size = []
-                    # for l, t, r, b in boxes:
-                    #     l = l * scale_col
-                    #     t = t * scale_row
-                    #     r = r * scale_col
-                    #     b = b * scale_row
-                    #     boxes_correct_size.append((l, t, r, b))
-                    # ids, counted_ids = tracker.update_detection_result(frame_id, boxes_correct_size)
-                    # update wait_time_estimator
-                    # wait_time_estimator.update(boxes, ids, tracker.alive_ids(), counted_ids, self.payment_area, img_w, img_h)
-
-                # if frame is not None:
-                if frame is not None:
-                    frame_display = utils_main.resize_max_size(frame, max_display_w, max_display_h)
-                    self.updateFrame.emit(frame_display)
-                hmap = heatmap.get_heatmap()
-                if hmap is not None:
-                    hmap = utils_main.resize_max_size(hmap, max_display_w, max_display_h)
-                    self.updateHeatmap.emit(hmap)
-            # save data to database if needed
-            now = datetime.datetime.now()
-            current_time = (now.year, now.month, now.day, now.hour)
-            if last_time != current_time:
-                hmap = heatmap.heatmap
-                count = heatmap.count
-                if last_heatmap is not None:
-                    diff_hmap = hmap - last_heatmap
-                    diff_count = count - last_heatmap_count
-                else:
-                    diff_hmap = hmap
-                    diff_count = count
-                if diff_count != 0:
-                    hour_heatmap = diff_hmap / diff_count
-                else:
-                    hour_heatmap = None
-                data = dict()
-                data['heatmap'] = hour_heatmap
-                data['frame'] = frame
-                storage_updater.update(*last_time, data)
-                last_heatmap = hmap
-                last_heatmap_count = count
-                # reset heatmap if need
-                if last_time[2] != current_time[2]:  # differ in date
-                    heatmap.reset()
-                last_time = current_time
-
-        video.release()
-        if human_detector is not None:
-            human_detector.stop()
+        self.pipeline.run()
 
     def stop(self):
-        self.stopped = True
+        self.pipeline.stop()
 
     @QtCore.pyqtSlot(list)
     def set_payment_area(self, list_points):
-        self.payment_area = list_points
-        path = os.path.join(config_main.DATABASE_DIR, 'payment_area.pkl')
-        with open(path, 'wb') as fo:
-            pickle.dump(self.payment_area, fo)
+        self.pipeline.set_payment_area(list_points)
 
 
 class FaceProcess(QtCore.QThread):
-    updateFrame = QtCore.pyqtSignal(np.ndarray)
+    """Runs the face pipeline on a Qt thread, its frames go to a DisplayWorker and the FaceIDs to the GUI thread"""
     updateFaceID = QtCore.pyqtSignal(int, np.ndarray, float, int)
 
-    def __init__(self):
+    def __init__(self, pipeline):
         super(FaceProcess, self).__init__()
-        self.stopped = False
+        self.pipeline = pipeline
+        self.pipeline.add_face_id_listener(self.updateFaceID.emit)
 
     def run(self):
-        video_uri = config_main.data['VIDEO_URI_FACE']
-        face_detector = RetinaFaceDetector(gpuid=config_main.data['FACE_DETECTION_GPU'])
-        ag_estimator = AgeGenderEstimator(gpuid=config_main.data['AGE_GENDER_GPU'])
-        # motion detection, we need this to save computing power when the scene is static
-        motion_detector = MotionDetection()
-        # tracker
-        tracker = SimpleTracker()
-        # faceid manager
-        faceid = FaceIDManager()
-        faceid.updateFaceID.connect(self.updateFaceID)
-        faceid.start()
-        # video stream object, that run on a different thread
-        video = QueuedStream(video_uri, True, 25)
-        video.start()
-        if not video.isOpened():
-            print("Can not open video")
-            return
-        # read some config
-        max_process_w = config_main.data['PROCESS_WIDTH_FACE']
-        max_process_h = config_main.data['PROCESS_HEIGHT_FACE']
-        max_display_w = config_main.data['DISPLAY_WIDTH_FACE']
-        max_display_h = config_main.data['DISPLAY_HEIGHT_FACE']
-        #
-        now = datetime.datetime.now()
-        last_time = (now.year, now.month, now.day, now.hour)
-        count = 0
-        male_count = 0
-        female_count = 0
-        age1_count = 0
-        age2_count = 0
-        age3_count = 0
-        age4_count = 0
-        tracking_list = {}
-        # processing loop
-        while not self.stopped:
-            ret, frame, frame_id = video.read()
-            if not ret:
-                break
-
-            frame_process = utils_main.resize_max_size(
-                frame, max_process_w, max_process_h)
-
-            if len(motion_detector.get_motion_region(frame_process)) > 0:
-                detection_result = face_detector.detect(frame_process)
-                if detection_result is not None:
-                    recs, points = detection_result
-                    # ignore small face
-                    next_recs = []
-                    next_points = []
-                    for rec, p in zip(recs, points):
-                        l, t, r, b = rec[:4]
-                        if (b - t + r - l) / 2 > config_main.data['MIN_FACE_SIZE']:
-                            next_recs.append(rec)
-                            next_points.append(p)
-                    recs = np.array(next_recs)
-                    points = np.array(next_points)
-
-                    # predict age and gender
-                    list_age = []
-                    list_gender = []
-                    for i in range(len(recs)):
-                        g, a = ag_estimator.predict(frame_process, recs[i], points[i])
-                        a += 5  # Asian guys alway look young =))
-                        list_age.append(a)
-                        list_gender.append(g)
-                    # update tracker
-                    recs = recs.astype('int')
-                    if len(recs) > 0:
-                        recs = recs[:, :4]  # ignore score column
-                    points = points.astype('int')
-                    ids, counted_ids = tracker.update(recs)
-                    # update count
-                    count += len(counted_ids)
-                    for i in counted_ids:
-                        print('Tracking ID go out of scene:', i)
-                        # update age count
-                        avg_age = sum(
-                            tracking_list[i]['age']) / len(tracking_list[i]['age'])
-                        if avg_age < 25:
-                            age1_count += 1
-                        elif avg_age < 35:
-                            age2_count += 1
-                        elif avg_age < 55:
-                            age3_count += 1
-                        else:
-                            age4_count += 1
-                        # update gender count
-                        avg_gender = sum(
-                            tracking_list[i]['gender']) / len(tracking_list[i]['gender'])
-                        if avg_gender < 0.5:
-                            female_count += 1
-                        else:
-                            male_count += 1
-                        # pass the data to the faceid manager
-                        if len(tracking_list[i]['face']) > 5:
-                            tracking_list[i]['face'] = random.sample(tracking_list[i]['face'], 5)
-                        faceid.put_data(tracking_list[i])
-                    # add to tracking_list
-                    for i, a, g, rec, point in zip(ids, list_age, list_gender, recs, points):
-                        if i not in tracking_list.keys():
-                            tracking_list[i] = dict()
-                            tracking_list[i]['timestamp'] = time.time()
-                            tracking_list[i]['age'] = []
-                            tracking_list[i]['gender'] = []
-                            tracking_list[i]['face'] = []
-                        tracking_list[i]['age'].append(a)
-                        tracking_list[i]['gender'].append(g)
-                        aligned_face = faceid.get_aligned_face(frame_process, rec, point)
-                        tracking_list[i]['face'].append(aligned_face)
-                        if len(tracking_list[i]['face']) > 20:
-                            del tracking_list[i]['face'][0]
-                            # del tracking_list[i]['age'][0]
-                            # del tracking_list[i]['gender'][0]
-                    # remove dead id
-                    alives = tracker.alive_ids()
-                    keys = list(tracking_list.keys())
-                    for k in keys:
-                        if k not in alives:
-                            del tracking_list[k]
-
-                    if frame is not None:
-                        frame_display = utils_main.resize_max_size(frame, max_display_w, max_display_h)
-                        if len(recs) > 0:
-                            scale_row = frame_display.shape[0] / frame_process.shape[0]
-                            scale_col = frame_display.shape[1] / frame_process.shape[1]
-                            for pid, box in zip(ids, recs):
-                                l, t, r, b = box
-                                l = int(l * scale_col)
-                                t = int(t * scale_row)
-                                r = int(r * scale_col)
-                                b = int(b * scale_row)
-                                cv2.rectangle(frame_display, (l, t), (r, b), (0, 0, 255), 2)
-                                # utils_main.putTextLabel(frame_display, (l, t), str(pid), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), (0, 0, 255), thickness=1, bottom=True)
-                        self.updateFrame.emit(frame_display)
-            # save data if needed
-            now = datetime.datetime.now()
-            current_time = (now.year, now.month, now.day, now.hour)
-            if last_time != current_time:
-                data = dict()
-                data['count'] = count
-                data['wait_time'] = 0
-                data['stay_time'] = 0
-                data['male'] = male_count
-                data['female'] = female_count
-                data['age1'] = age1_count
-                data['age2'] = age2_count
-                data['age3'] = age3_count
-                data['age4'] = age4_count
-                storage_updater.update(*last_time, data)
-                last_time = current_time
-                count = 0
-                male_count = 0
-                female_count = 0
-                age1_count = 0
-                age2_count = 0
-                age3_count = 0
-                age4_count = 0
-        faceid.stop()
-        video.release()
+        self.pipeline.run()
 
     def stop(self):
-        self.stopped = True
+        self.pipeline.stop()
 
 
 if __name__ == '__main__':
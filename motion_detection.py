@@ -1,58 +1,104 @@
 """Motion detection modules."""
 
+from collections import namedtuple
+
 import cv2
 
-import imutils
+import config_main
 
 MIN_SIZE = (30, 30)
+# width of the grayscale image the background model runs on
+WORKING_WIDTH = config_main.data['MOTION_WIDTH']
+# contours closer than this many working pixels are clustered into one region
+MERGE_DISTANCE = config_main.data['MOTION_MERGE_DISTANCE']
+LEARNING_RATE = 0.00075
+
+# a motion region in frame coordinates, area is the number of moving pixels in frame pixels
+# and intensity the part of the region that moves, in [0, 1]
+MotionRegion = namedtuple('MotionRegion', ['x', 'y', 'w', 'h', 'area', 'intensity'])
 
 
 class MotionDetection:
-    def __init__(self, min_size=MIN_SIZE):
+    def __init__(self, min_size=MIN_SIZE, width=WORKING_WIDTH, merge_distance=MERGE_DISTANCE):
         self.mog = cv2.createBackgroundSubtractorMOG2()
         self.min_size = min_size
+        self.width = width
+        self.merge_kernel = None
+        if merge_distance > 0:
+            self.merge_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (merge_distance, merge_distance))
+        # part of the frame that moved in the last frame, in [0, 1]
+        self.motion_energy = 0.0
 
-    def get_motion_region(self, frame):
-        """Return region with motion."""
+    def _foreground(self, frame):
+        """Update the background model, return the foreground mask and its scale to the frame"""
         orig_size = frame.shape[1]
-        new_size = min(orig_size, 200)
+        new_size = min(orig_size, self.width)
         scale = float(orig_size) / new_size
 
+        frame_local = frame
+        if frame_local.ndim == 3:
+            frame_local = cv2.cvtColor(frame_local, cv2.COLOR_BGR2GRAY)
         if orig_size != new_size:
-            frame_local = imutils.resize(frame, width=new_size)
+            new_height = max(1, int(round(frame.shape[0] / scale)))
+            frame_local = cv2.resize(frame_local, (new_size, new_height), interpolation=cv2.INTER_AREA)
 
         frame_local = cv2.blur(frame_local, (3, 3))
 
-        mask = self.mog.apply(frame_local, learningRate=0.00075)
+        mask = self.mog.apply(frame_local, learningRate=LEARNING_RATE)
+        # MOG2 marks shadows as 127, they are not motion
+        mask = cv2.threshold(mask, 200, 255, cv2.THRESH_BINARY)[1]
         mask = cv2.dilate(mask, None, iterations=1)
+        return mask, scale
 
-        # cv2.imshow('Mask', mask)
+    def get_motion_regions(self, frame):
+        """Return the clustered regions with motion as a list of MotionRegion, largest first.
+        There is motion when the box enclosing all the regions is larger than min_size, like get_motion_region,
+        a small region is kept with the others. Also updates motion_energy."""
+        mask, scale = self._foreground(frame)
+        self.motion_energy = cv2.countNonZero(mask) / float(mask.size)
+        if self.motion_energy == 0:
+            return []
 
+        cluster_mask = mask
+        if self.merge_kernel is not None:
+            cluster_mask = cv2.dilate(mask, self.merge_kernel)
         contours, _ = cv2.findContours(
-            mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            cluster_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-        t = mask.shape[0]
-        b = 0
-        l = mask.shape[1]
-        r = 0
         ret = []
         for c in contours:
             (x, y, w, h) = cv2.boundingRect(c)
-            t = min(t, y)
-            b = max(b, y + h)
-            l = min(l, x)
-            r = max(r, x + w)
-
-        t = int(scale * t - 1)
-        b = int(scale * b + 1)
-        l = int(scale * l - 1)
-        r = int(scale * r + 1)
-
-        t = max(t, 0)
-        b = min(b, frame.shape[0])
-        l = max(l, 0)
-        r = min(r, frame.shape[1])
-
-        if l < r and t < b and (r - l) > self.min_size[0] and (b - t) > self.min_size[1]:
-            ret.append((l, t, r - l, b - t))
+            moving = cv2.countNonZero(mask[y:y + h, x:x + w])
+            if moving == 0:
+                continue
+            intensity = moving / float(w * h)
+
+            l = max(int(scale * x - 1), 0)
+            t = max(int(scale * y - 1), 0)
+            r = min(int(scale * (x + w) + 1), frame.shape[1])
+            b = min(int(scale * (y + h) + 1), frame.shape[0])
+            if l < r and t < b:
+                ret.append(MotionRegion(l, t, r - l, b - t, moving * scale * scale, intensity))
+        if len(ret) == 0:
+            return []
+        width = max(region.x + region.w for region in ret) - min(region.x for region in ret)
+        height = max(region.y + region.h for region in ret) - min(region.y for region in ret)
+        if width <= self.min_size[0] or height <= self.min_size[1]:
+            return []
+        ret.sort(key=lambda region: region.area, reverse=True)
         return ret
+
+    def get_motion_region(self, frame):
+        """Return region with motion, a single (x, y, w, h) enclosing all the motion regions."""
+        regions = self.get_motion_regions(frame)
+        if len(regions) == 0:
+            return []
+        l = min(region.x for region in regions)
+        t = min(region.y for region in regions)
+        r = max(region.x + region.w for region in regions)
+        b = max(region.y + region.h for region in regions)
+        return [(l, t, r - l, b - t)]
+
+    def get_motion_energy(self):
+        """Part of the frame that moved in the last processed frame, in [0, 1]"""
+        return self.motion_energy
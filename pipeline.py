@@ -0,0 +1,535 @@
+"""The processing pipelines of the cameras, without any GUI.
+
+The Qt window (main.py) and the headless runner (run_headless.py) both drive them,
+the window subscribes to the frames and results it shows."""
+
+import datetime
+import os
+import pickle
+import random
+import threading
+
+import cv2
+import numpy as np
+
+import clock
+import config_main
+import detector_service
+import utils_main
+from face_age_gender.age_gender_estimator import AgeGenderEstimator
+from face_detection import FaceDetector
+from faceid import FaceIDManager
+from frame_rate_controller import FrameRateController
+from heatmap import HeatMap
+from heatmap_store import HeatmapStore
+from heatmap_updater import HeatmapUpdater
+from human_detection import HumanDetector
+from motion_detection import MotionDetection
+from roi_detection import RoiSelector
+from storage_update import StorageUpdater
+# from tracker_2 import Tracker
+from tracker_3 import SimpleTracker
+from videostream import QueuedStream
+
+# from wait_time_estimate import WaitTimeEstimator
+
+# Do not run performance tests to find the best convolution algorithm
+os.environ["MXNET_CUDNN_AUTOTUNE_DEFAULT"] = "0"
+
+
+class Pipeline:
+    """Processing loop of one camera, run() returns when the stream ends or after stop()"""
+
+    def __init__(self, storage_updater):
+        self.storage_updater = storage_updater
+        self.stopped = False
+        self.frame_listeners = []
+        # the stream run() reads, stopped with the pipeline so a read waiting for a reconnect returns
+        self.video = None
+
+    def add_frame_listener(self, callback):
+        """callback(frame) gets the frame at display size, frames are only resized when there is a listener"""
+        self.frame_listeners.append(callback)
+
+    def run(self):
+        raise NotImplementedError
+
+    def stop(self):
+        self.stopped = True
+        video = self.video
+        if video is not None:
+            video.stop(wait=False)
+
+    @staticmethod
+    def _emit(listeners, *args):
+        for callback in listeners:
+            callback(*args)
+
+
+class HumanPipeline(Pipeline):
+    """People detection and heatmap of the store camera"""
+
+    def __init__(self, storage_updater):
+        super(HumanPipeline, self).__init__(storage_updater)
+        self.heatmap_listeners = []
+        # minute and hour heatmaps, the hours go to the hour rows once the store saved them
+        self.heatmap_store = HeatmapStore()
+        self.heatmap_store.add_listener(
+            lambda key, hmap, old_hmap: self.storage_updater.update(*key, {'heatmap': hmap}))
+        self.payment_area = []
+        path = os.path.join(config_main.DATABASE_DIR, 'payment_area.pkl')
+        if os.path.exists(path):
+            with open(path, 'rb') as fi:
+                self.payment_area = pickle.load(fi)
+
+    def add_heatmap_listener(self, callback):
+        """callback(hmap) gets the heatmap at display size after each detection, the heatmap of the day or
+        of the last HEATMAP_DISPLAY_MINUTES"""
+        self.heatmap_listeners.append(callback)
+
+    def get_recent_heatmap(self, minutes):
+        """Mean heatmap of the last minutes, up to HEATMAP_ROLLING_MINUTES"""
+        return self.heatmap_store.window(minutes * 60)
+
+    def run(self):
+        video_uri = config_main.data['VIDEO_URI']
+        # a lower resolution substream of the camera is enough for counting and costs far less to decode
+        if len(config_main.data['VIDEO_SUBSTREAM_URI']) > 0:
+            video_uri = config_main.data['VIDEO_SUBSTREAM_URI']
+        # object detector, that run on a different process, or on the worker pool shared by all cameras
+        if config_main.data['HUMAN_DETECTION'] is True:
+            if config_main.data['DETECTION_SERVICE'] is True:
+                human_detector = detector_service.get_service().register_stream()
+            else:
+                human_detector = HumanDetector()
+            human_detector.start()
+        else:
+            human_detector = None
+        # motion detection, we need this to save computing power when the scene is static
+        motion_detector = MotionDetection()
+        # crop of the motion region the detector runs on
+        roi_selector = RoiSelector()
+        # replaying a recording runs on the video time, as fast as the detector allows
+        replay = clock.REPLAY
+        replay_start = clock.replay_start_time() if replay else None
+        video_clock = clock.VideoClock(replay_start) if replay else clock.Clock()
+        # how many frames per second go to the detector, a batch of frames can be in flight
+        rate_controller = FrameRateController(max_in_flight=2 * config_main.data['DETECTION_BATCH_SIZE'],
+                                              clock=video_clock.time)
+        # heatmap
+        heatmap = HeatMap()
+        # tracker
+        # tracker = Tracker()
+        # wait time estimator
+        # wait_time_estimator = WaitTimeEstimator()
+        # video stream object, that run on a different thread
+        # read some config
+        max_process_w = config_main.data['PROCESS_WIDTH']
+        max_process_h = config_main.data['PROCESS_HEIGHT']
+        max_display_w = config_main.data['DISPLAY_WIDTH']
+        max_display_h = config_main.data['DISPLAY_HEIGHT']
+        # frames are never used above the process and display sizes
+        decode_size = (max(max_process_w, max_display_w), max(max_process_h, max_display_h))
+        # a replay keeps every frame
+        video = QueuedStream(video_uri, not replay, 25, decode_size=decode_size, replay_start=replay_start)
+        try:
+            video.start()
+            self.video = video
+            if not video.isOpened():
+                print("Can not open video")
+                return
+            #
+            now = video_clock.now()
+            last_time = (now.year, now.month, now.day, now.hour)
+            last_minute = int(video_clock.time() // 60)
+            last_frame = None
+            # show the last minutes instead of the whole day, the window changes once a minute
+            display_minutes = config_main.data['HEATMAP_DISPLAY_MINUTES']
+            recent_hmap = None
+            recent_version = 0
+            # version of the heatmap sent to the listeners last
+            emitted_version = None
+            # processing loop
+            while not self.stopped:
+                # the stream reconnects by itself, it only ends at the end of a file
+                ret, frame, frame_id, time_stamp = video.read(with_timestamp=True)
+                if not ret:
+                    break
+                if replay:
+                    video_clock.set(time_stamp)
+                last_frame = frame
+
+                frame_process = utils_main.resize_max_size(
+                    frame, max_process_w, max_process_h)
+
+                # scale_row = frame.shape[0] / frame_process.shape[0]
+                # scale_col = frame.shape[1] / frame_process.shape[1]
+
+                motion_regions = motion_detector.get_motion_regions(frame_process)
+                if len(motion_regions) > 0:
+                    # put the current frame to the tracking list
+                    # tracker.update_frame(frame_id, time_stamp, frame)
+                    # put the current frame to the detection queue, discard the oldest queued frame if the queue is full
+                    if config_main.data['HUMAN_DETECTION'] is True:
+                        sent = rate_controller.should_process(motion_detector.motion_energy)
+                        if sent:
+                            crop = roi_selector.select(frame_id, frame_process, motion_regions)
+                            # a dropped frame has no result to wait for
+                            sent = human_detector.put_frame(frame_id, crop)
+                            if sent:
+                                rate_controller.sent(frame_id)
+                            else:
+                                roi_selector.pop_offset(frame_id)
+                        if replay and sent:
+                            # wait for the result of this frame, so every replay processes the same frames
+                            detection_results = [human_detector.get_result()]
+                        else:
+                            # get detection results of the old frames if results are available,
+                            # in batched mode several results may arrive at once
+                            detection_results = human_detector.get_results()
+                    else:
+                        detection_results = []
+                    for detection_result in detection_results:
+                        frame_id, _, _, boxes = detection_result
+                        rate_controller.done(frame_id)
+                        boxes = roi_selector.shift_boxes(boxes, roi_selector.pop_offset(frame_id))
+                        # update heatmap
+                        heatmap.update(boxes, frame_process.shape[:2])
+                        # update tracker
+                        # boxes_correct_size = []
+                        # for l, t, r, b in boxes:
+                        #     l = l * scale_col
+                        #     t = t * scale_row
+                        #     r = r * scale_col
+                        #     b = b * scale_row
+                        #     boxes_correct_size.append((l, t, r, b))
+                        # ids, counted_ids = tracker.update_detection_result(frame_id, boxes_correct_size)
+                        # update wait_time_estimator
+                        # wait_time_estimator.update(boxes, ids, tracker.alive_ids(), counted_ids, self.payment_area, img_w, img_h)
+
+                    # nothing is resized for display when nobody watches
+                    if frame is not None and len(self.frame_listeners) > 0:
+                        frame_display = utils_main.resize_max_size(frame, max_display_w, max_display_h)
+                        self._emit(self.frame_listeners, frame_display)
+                    # the heatmap is only resized and sent again when it changed
+                    version = heatmap.version if display_minutes <= 0 else recent_version
+                    if len(self.heatmap_listeners) > 0 and version != emitted_version:
+                        hmap = heatmap.get_heatmap() if display_minutes <= 0 else recent_hmap
+                        if hmap is not None:
+                            hmap = utils_main.resize_max_size(hmap, max_display_w, max_display_h)
+                            self._emit(self.heatmap_listeners, hmap)
+                            emitted_version = version
+                # the heatmap of the minute that ended goes to the store
+                minute = int(time_stamp // 60)
+                if minute != last_minute:
+                    self.heatmap_store.record(last_minute * 60, *heatmap.get_sum())
+                    last_minute = minute
+                    if display_minutes > 0 and len(self.heatmap_listeners) > 0:
+                        recent_hmap = self.get_recent_heatmap(display_minutes)
+                        recent_version += 1
+                # save data to database if needed
+                now = datetime.datetime.fromtimestamp(time_stamp)
+                current_time = (now.year, now.month, now.day, now.hour)
+                if last_time != current_time:
+                    self._save_hour(last_time, frame)
+                    # reset heatmap if need
+                    if last_time[2] != current_time[2]:  # differ in date
+                        heatmap.reset()
+                        self.heatmap_store.restart()
+                    last_time = current_time
+
+            self.heatmap_store.record(last_minute * 60, *heatmap.get_sum())
+            if replay and last_frame is not None:
+                # a live run saves the last hour once the clock passes it, the recording ends before
+                self._save_hour(last_time, last_frame)
+        finally:
+            # the detector process and its shared memory go away on every exit
+            self.heatmap_store.close()
+            print('Video stream:', video.get_stats())
+            video.release()
+            if human_detector is not None:
+                print('Human detection throughput:', human_detector.get_throughput())
+                print('Human detection frame rate:', rate_controller.get_stats())
+                human_detector.stop()
+
+    def _save_hour(self, hour, frame):
+        """The heatmap of the hour is saved by the store, its listener adds it to the hour row"""
+        self.heatmap_store.end_hour(hour)
+        data = dict()
+        data['frame'] = frame
+        self.storage_updater.update(*hour, data)
+
+    def set_payment_area(self, list_points):
+        self.payment_area = list_points
+        path = os.path.join(config_main.DATABASE_DIR, 'payment_area.pkl')
+        with open(path, 'wb') as fo:
+            pickle.dump(self.payment_area, fo)
+
+
+class FacePipeline(Pipeline):
+    """Face detection, age, gender and FaceID of the entrance camera"""
+
+    def __init__(self, storage_updater):
+        super(FacePipeline, self).__init__(storage_updater)
+        self.face_id_listeners = []
+
+    def add_face_id_listener(self, callback):
+        """callback(cid, face, timestamp, count) gets every customer FaceID recognised"""
+        self.face_id_listeners.append(callback)
+
+    def run(self):
+        video_uri = config_main.data['VIDEO_URI_FACE']
+        if len(config_main.data['VIDEO_SUBSTREAM_URI_FACE']) > 0:
+            video_uri = config_main.data['VIDEO_SUBSTREAM_URI_FACE']
+        # replaying a recording runs on the video time, as fast as the detector allows
+        replay = clock.REPLAY
+        replay_start = clock.replay_start_time() if replay else None
+        video_clock = clock.VideoClock(replay_start) if replay else clock.Clock()
+        # face detector, that run on a different thread, or inline in a replay so no frame is dropped
+        face_detector = FaceDetector(threaded=False) if replay else FaceDetector()
+        face_detector.start()
+        ag_estimator = AgeGenderEstimator(gpuid=config_main.data['AGE_GENDER_GPU'])
+        # motion detection, we need this to save computing power when the scene is static
+        motion_detector = MotionDetection()
+        # crop of the motion region the detector runs on
+        roi_selector = RoiSelector()
+        # how many frames per second go to the face detector
+        rate_controller = FrameRateController(clock=video_clock.time)
+        # tracker
+        tracker = SimpleTracker(clock=video_clock.time)
+        # faceid manager
+        faceid = FaceIDManager()
+        faceid.add_listener(lambda *args: self._emit(self.face_id_listeners, *args))
+        faceid.start()
+        # video stream object, that run on a different thread
+        # read some config
+        max_process_w = config_main.data['PROCESS_WIDTH_FACE']
+        max_process_h = config_main.data['PROCESS_HEIGHT_FACE']
+        max_display_w = config_main.data['DISPLAY_WIDTH_FACE']
+        max_display_h = config_main.data['DISPLAY_HEIGHT_FACE']
+        # frames are never used above the process and display sizes
+        decode_size = (max(max_process_w, max_display_w), max(max_process_h, max_display_h))
+        # a replay keeps every frame
+        video = QueuedStream(video_uri, not replay, 25, decode_size=decode_size, replay_start=replay_start)
+        try:
+            video.start()
+            self.video = video
+            if not video.isOpened():
+                print("Can not open video")
+                return
+            #
+            now = video_clock.now()
+            last_time = (now.year, now.month, now.day, now.hour)
+            count = 0
+            male_count = 0
+            female_count = 0
+            age1_count = 0
+            age2_count = 0
+            age3_count = 0
+            age4_count = 0
+            tracking_list = {}
+            # frames sent to the face detector, waiting for their detection result
+            pending_frames = {}
+            warmed_up = False
+            # processing loop
+            while not self.stopped:
+                # the stream reconnects by itself, it only ends at the end of a file
+                ret, frame, frame_id, time_stamp = video.read(with_timestamp=True)
+                if not ret:
+                    break
+                if replay:
+                    video_clock.set(time_stamp)
+
+                frame_process = utils_main.resize_max_size(
+                    frame, max_process_w, max_process_h)
+                if not warmed_up:
+                    # bind the network to the process size and the crop sizes once, before the first detection
+                    face_detector.warm_up(roi_selector.shapes(frame_process.shape) if roi_selector.enabled
+                                          else [frame_process.shape[:2]])
+                    warmed_up = True
+
+                motion_regions = motion_detector.get_motion_regions(frame_process)
+                if len(motion_regions) > 0 and rate_controller.should_process(motion_detector.motion_energy):
+                    face_detector.put_frame(frame_id, roi_selector.select(frame_id, frame_process, motion_regions))
+                    rate_controller.sent(frame_id)
+                    pending_frames[frame_id] = (frame, frame_process)
+                # match finished detections back to their frames, older frames will never get a result
+                for result_id, recs, points in face_detector.get_results():
+                    if result_id not in pending_frames:
+                        continue
+                    frame, frame_process = pending_frames.pop(result_id)
+                    rate_controller.done(result_id)
+                    for fid in [fid for fid in pending_frames if fid < result_id]:
+                        del pending_frames[fid]
+                    offset = roi_selector.pop_offset(result_id)
+                    recs = roi_selector.shift_boxes(recs, offset)
+                    points = roi_selector.shift_points(points, offset)
+                    # ignore small face
+                    next_recs = []
+                    next_points = []
+                    for rec, p in zip(recs, points):
+                        l, t, r, b = rec[:4]
+                        if (b - t + r - l) / 2 > config_main.data['MIN_FACE_SIZE']:
+                            next_recs.append(rec)
+                            next_points.append(p)
+                    recs = np.array(next_recs)
+                    points = np.array(next_points)
+
+                    # predict age and gender
+                    list_age = []
+                    list_gender = []
+                    for i in range(len(recs)):
+                        g, a = ag_estimator.predict(frame_process, recs[i], points[i])
+                        a += 5  # Asian guys alway look young =))
+                        list_age.append(a)
+                        list_gender.append(g)
+                    # update tracker
+                    recs = recs.astype('int')
+                    if len(recs) > 0:
+                        recs = recs[:, :4]  # ignore score column
+                    points = points.astype('int')
+                    ids, counted_ids = tracker.update(recs)
+                    # update count
+                    count += len(counted_ids)
+                    for i in counted_ids:
+                        print('Tracking ID go out of scene:', i)
+                        # update age count
+                        avg_age = sum(
+                            tracking_list[i]['age']) / len(tracking_list[i]['age'])
+                        if avg_age < 25:
+                            age1_count += 1
+                        elif avg_age < 35:
+                            age2_count += 1
+                        elif avg_age < 55:
+                            age3_count += 1
+                        else:
+                            age4_count += 1
+                        # update gender count
+                        avg_gender = sum(
+                            tracking_list[i]['gender']) / len(tracking_list[i]['gender'])
+                        if avg_gender < 0.5:
+                            female_count += 1
+                        else:
+                            male_count += 1
+                        # pass the data to the faceid manager
+                        if len(tracking_list[i]['face']) > 5:
+                            tracking_list[i]['face'] = random.sample(tracking_list[i]['face'], 5)
+                        faceid.put_data(tracking_list[i])
+                    # add to tracking_list
+                    for i, a, g, rec, point in zip(ids, list_age, list_gender, recs, points):
+                        if i not in tracking_list.keys():
+                            tracking_list[i] = dict()
+                            tracking_list[i]['timestamp'] = video_clock.time()
+                            tracking_list[i]['age'] = []
+                            tracking_list[i]['gender'] = []
+                            tracking_list[i]['face'] = []
+                        tracking_list[i]['age'].append(a)
+                        tracking_list[i]['gender'].append(g)
+                        aligned_face = faceid.get_aligned_face(frame_process, rec, point)
+                        tracking_list[i]['face'].append(aligned_face)
+                        if len(tracking_list[i]['face']) > 20:
+                            del tracking_list[i]['face'][0]
+                            # del tracking_list[i]['age'][0]
+                            # del tracking_list[i]['gender'][0]
+                    # remove dead id
+                    alives = tracker.alive_ids()
+                    keys = list(tracking_list.keys())
+                    for k in keys:
+                        if k not in alives:
+                            del tracking_list[k]
+
+                    if frame is not None and len(self.frame_listeners) > 0:
+                        frame_display = utils_main.resize_max_size(frame, max_display_w, max_display_h)
+                        if len(recs) > 0:
+                            scale_row = frame_display.shape[0] / frame_process.shape[0]
+                            scale_col = frame_display.shape[1] / frame_process.shape[1]
+                            for pid, box in zip(ids, recs):
+                                l, t, r, b = box
+                                l = int(l * scale_col)
+                                t = int(t * scale_row)
+                                r = int(r * scale_col)
+                                b = int(b * scale_row)
+                                cv2.rectangle(frame_display, (l, t), (r, b), (0, 0, 255), 2)
+                                # utils_main.putTextLabel(frame_display, (l, t), str(pid), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), (0, 0, 255), thickness=1, bottom=True)
+                        self._emit(self.frame_listeners, frame_display)
+                # save data if needed
+                now = datetime.datetime.fromtimestamp(time_stamp)
+                current_time = (now.year, now.month, now.day, now.hour)
+                if last_time != current_time:
+                    self._save_hour(last_time, count, male_count, female_count,
+                                    age1_count, age2_count, age3_count, age4_count)
+                    last_time = current_time
+                    count = 0
+                    male_count = 0
+                    female_count = 0
+                    age1_count = 0
+                    age2_count = 0
+                    age3_count = 0
+                    age4_count = 0
+            if replay:
+                # a live run saves the last hour once the clock passes it, the recording ends before
+                self._save_hour(last_time, count, male_count, female_count,
+                                age1_count, age2_count, age3_count, age4_count)
+        finally:
+            # the detector thread and FaceID manager are stopped on every exit
+            print('Face detection frame rate:', rate_controller.get_stats())
+            face_detector.stop()
+            faceid.stop()
+            print('Face video stream:', video.get_stats())
+            video.release()
+
+    def _save_hour(self, hour, count, male_count, female_count, age1_count, age2_count, age3_count, age4_count):
+        data = dict()
+        data['count'] = count
+        data['wait_time'] = 0
+        data['stay_time'] = 0
+        data['male'] = male_count
+        data['female'] = female_count
+        data['age1'] = age1_count
+        data['age2'] = age2_count
+        data['age3'] = age3_count
+        data['age4'] = age4_count
+        self.storage_updater.update(*hour, data)
+
+
+class Engine:
+    """Counting, heatmap, storage and upload of the store, the pipelines run on their own threads"""
+
+    def __init__(self, human=True, face=True):
+        self.storage_updater = StorageUpdater()
+        self.heatmap_updater = HeatmapUpdater()
+        self.human = HumanPipeline(self.storage_updater) if human else None
+        if self.human is not None:
+            # day and month heatmaps are rolled up as the hours are saved
+            self.heatmap_updater.watch(self.human.heatmap_store)
+        self.face = FacePipeline(self.storage_updater) if face else None
+        self.threads = []
+
+    def pipelines(self):
+        return [p for p in (self.human, self.face) if p is not None]
+
+    def start(self, threaded=True):
+        """Start the background jobs, and the pipelines unless the caller runs them itself"""
+        self.heatmap_updater.start()
+        if threaded:
+            for pipeline in self.pipelines():
+                th = threading.Thread(target=pipeline.run)
+                th.daemon = True
+                th.start()
+                self.threads.append(th)
+
+    def is_running(self):
+        return any(th.is_alive() for th in self.threads)
+
+    def wait(self, timeout=None):
+        for th in self.threads:
+            th.join(timeout)
+
+    def stop(self):
+        for pipeline in self.pipelines():
+            pipeline.stop()
+        self.wait()
+        self.threads = []
+        self.storage_updater.flush()
+        self.heatmap_updater.stop()
+        detector_service.stop_service()
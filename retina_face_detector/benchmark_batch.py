@@ -0,0 +1,61 @@
+"""Throughput of RetinaFace on the CPU with one forward pass per batch.
+
+Usage: python3 benchmark_batch.py <image dir> [--batch-sizes 1 2 4 8 16 32] [--max-size 640] [--model-dir models]
+
+e.g. cd retina_face_detector && python3 benchmark_batch.py ~/faces --batch-sizes 1 4 8
+The model is set up as in README.md and the cython tools are built with make.
+
+Images are downscaled to fit --max-size, the batch is padded to the largest image of the batch."""
+
+import argparse
+import os
+import time
+
+import cv2
+
+from face_detector import RetinaFaceDetector
+
+EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def read_images(image_dir, max_size):
+    images = []
+    for name in sorted(os.listdir(image_dir)):
+        if not name.lower().endswith(EXTENSIONS):
+            continue
+        img = cv2.imread(os.path.join(image_dir, name))
+        if img is None:
+            continue
+        scale = max_size / max(img.shape[:2])
+        if scale < 1.0:
+            img = cv2.resize(img, None, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+        images.append(img)
+    return images
+
+
+def run(detector, images, batch_size):
+    # warm up, binds the module of the batch shape
+    detector.detect_batch(images[:batch_size])
+    start = time.time()
+    for i in range(0, len(images), batch_size):
+        detector.detect_batch(images[i:i + batch_size])
+    return len(images) / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark batched RetinaFace detection')
+    parser.add_argument('image_dir', help='directory of images')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--max-size', type=int, default=640, help='longest side of the images')
+    parser.add_argument('--model-dir', default=None, help='folder with mnet.25/, models/ next to this script by default')
+    args = parser.parse_args()
+
+    images = read_images(args.image_dir, args.max_size)
+    if len(images) == 0:
+        print('No images in', args.image_dir)
+        exit(1)
+    detector = RetinaFaceDetector(gpuid=-1, model_dir=args.model_dir)
+    print('Images:', len(images))
+    print('{:>10} {:>12}'.format('batch size', 'images/s'))
+    for batch_size in args.batch_sizes:
+        print('{:>10} {:>12.2f}'.format(batch_size, run(detector, images, batch_size)))
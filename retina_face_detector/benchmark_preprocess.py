@@ -0,0 +1,45 @@
+import sys
+import time
+
+import numpy as np
+
+from retinaface import image_to_tensor
+
+WIDTH = 1280
+HEIGHT = 720
+REPEAT = 100
+
+
+def legacy_input(img, pixel_means, pixel_stds, pixel_scale):
+    """The preprocessing RetinaFace.detect used to do"""
+    im = img.copy()
+    im = im.astype(np.float32)
+    im_tensor = np.zeros((1, 3, im.shape[0], im.shape[1]))
+    for i in range(3):
+        im_tensor[0, i, :, :] = (im[:, :, 2 - i] / pixel_scale - pixel_means[2 - i]) / pixel_stds[2 - i]
+    return im_tensor
+
+
+def timeit(func):
+    func()
+    start = time.time()
+    for _ in range(REPEAT):
+        func()
+    return (time.time() - start) / REPEAT * 1000
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3:
+        WIDTH, HEIGHT = int(sys.argv[1]), int(sys.argv[2])
+    img = np.random.randint(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8)
+    means = np.array([103.939, 116.779, 123.68], dtype=np.float32)
+    stds = np.array([1.0, 1.0, 1.0], dtype=np.float32)
+    scale = (1.0 / stds[::-1]).reshape((1, 3, 1, 1))
+    bias = (-means[::-1] / stds[::-1]).reshape((1, 3, 1, 1))
+    buf = np.empty((1, 3, HEIGHT, WIDTH), dtype=np.float32)
+
+    print('Input:', WIDTH, 'x', HEIGHT)
+    print('legacy, no normalisation:   %.2f ms' % timeit(lambda: legacy_input(img, np.zeros(3), np.ones(3), 1.0)))
+    print('buffer, no normalisation:   %.2f ms' % timeit(lambda: image_to_tensor(img, buf)))
+    print('legacy, mean normalisation: %.2f ms' % timeit(lambda: legacy_input(img, means, stds, 1.0)))
+    print('buffer, mean normalisation: %.2f ms' % timeit(lambda: image_to_tensor(img, buf, scale, bias)))
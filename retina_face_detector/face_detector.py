@@ -4,19 +4,33 @@ import sys
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
 
 sys.path.append(THIS_DIR)
+# detector_backend is at the root of the repo, for the tools started from this folder
+sys.path.append(os.path.dirname(THIS_DIR))
 
+from detector_backend import DetectorBackend
 from retinaface import RetinaFace
 
 THRESHOLD = 0.8
 GPUID = 0  # -1 to use CPU
 
 
-class RetinaFaceDetector:
+class RetinaFaceDetector(DetectorBackend):
+    name = 'retinaface'
+
     def __init__(self, gpuid=GPUID, model_dir=None):
         if model_dir is None:
             model_dir = os.path.join(THIS_DIR, 'models')
         MODEL_PREFIX = os.path.join(model_dir, 'mnet.25', 'mnet.25')
         self.detector = RetinaFace(MODEL_PREFIX, 0, gpuid, 'net3')
 
-    def detect(self, img, thresh=THRESHOLD):
-        return self.detector.detect(img, thresh)
+    def warm_up(self, image_sizes, scales=[1.0]):
+        """Pre-bind the network to the (height, width) image sizes that will be used"""
+        self.detector.warm_up(image_sizes, scales)
+
+    def detect(self, img, thresh=THRESHOLD, scale=1.0):
+        """Detect at img resized by scale, boxes and landmarks are returned in img coordinates"""
+        return self.detector.detect(img, thresh, scales=[scale])
+
+    def detect_batch(self, images, thresh=THRESHOLD):
+        """Detect faces in all images with a single forward pass"""
+        return self.detector.detect_batch(images, thresh)
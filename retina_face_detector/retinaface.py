@@ -7,6 +7,7 @@ import numpy as np
 import mxnet as mx
 from mxnet import ndarray as nd
 import cv2
+from collections import OrderedDict
 #from rcnn import config
 from rcnn.logger import logger
 #from rcnn.processing.bbox_transform import nonlinear_pred, clip_boxes, landmark_pred
@@ -15,6 +16,30 @@ from rcnn.processing.generate_anchor import generate_anchors_fpn, anchors_plane
 from rcnn.processing.nms import gpu_nms_wrapper, cpu_nms_wrapper
 from rcnn.processing.bbox_transform import bbox_overlaps
 
+MAX_INPUT_BUFFERS = 8
+MAX_ANCHOR_CACHE = 32
+MAX_MODULE_CACHE = 8
+
+def anchor_geometry(boxes):
+  """Widths, heights and centres of boxes [N 4], as bbox_pred and landmark_pred use them"""
+  widths = boxes[:, 2] - boxes[:, 0] + 1.0
+  heights = boxes[:, 3] - boxes[:, 1] + 1.0
+  ctr_x = boxes[:, 0] + 0.5 * (widths - 1.0)
+  ctr_y = boxes[:, 1] + 0.5 * (heights - 1.0)
+  return widths, heights, ctr_x, ctr_y
+
+def image_to_tensor(im, out, scale=None, bias=None):
+  """
+  Fill the float32 NCHW tensor out (1, 3, H, W) from a BGR HWC image in one pass:
+  BGR -> RGB swap, layout change and normalisation out = im * scale + bias.
+  scale and bias are (1, 3, 1, 1) arrays in RGB order, None means no normalisation.
+  """
+  np.copyto(out[0], im[:, :, ::-1].transpose(2, 0, 1), casting='unsafe')
+  if scale is not None:
+    out *= scale
+    out += bias
+  return out
+
 class RetinaFace:
   def __init__(self, prefix, epoch, ctx_id=0, network='net3', nms=0.4, nocrop=False, decay4 = 0.5, vote=False):
     self.ctx_id = ctx_id
@@ -121,6 +146,17 @@ class RetinaFace:
     self.pixel_stds = np.array(pixel_stds, dtype=np.float32)
     self.pixel_scale = float(pixel_scale)
     print('means', self.pixel_means)
+    # (x/pixel_scale - mean)/std as x*scale + bias, in RGB order
+    if np.any(self.pixel_means != 0) or np.any(self.pixel_stds != 1) or self.pixel_scale != 1.0:
+      self._input_scale = (1.0 / (self.pixel_scale * self.pixel_stds[::-1])).reshape((1, 3, 1, 1))
+      self._input_bias = (-self.pixel_means[::-1] / self.pixel_stds[::-1]).reshape((1, 3, 1, 1))
+    else:
+      self._input_scale = None
+      self._input_bias = None
+    # preallocated input tensors, keyed by image shape
+    self._input_buffers = {}
+    # anchors of each feature map, keyed by (height, width, stride), least recently used first
+    self._anchor_cache = OrderedDict()
     self.use_landmarks = False
     if len(sym)//len(self._feat_stride_fpn)==3:
       self.use_landmarks = True
@@ -136,12 +172,89 @@ class RetinaFace:
     self.model = mx.mod.Module(symbol=sym, context=self.ctx, label_names = None)
     self.model.bind(data_shapes=[('data', (1, 3, image_size[0], image_size[1]))], for_training=False)
     self.model.set_params(arg_params, aux_params)
+    self.sym = sym
+    # modules bound to each input shape, all sharing the parameters of self.model, least recently used first
+    self._modules = OrderedDict()
+    self._modules[(1, 3, image_size[0], image_size[1])] = self.model
+
+  def _prepare_tensor(self, im):
+    """Return the normalised NCHW float32 tensor of a BGR image, in a buffer reused for each shape"""
+    key = im.shape[:2]
+    im_tensor = self._input_buffers.get(key)
+    if im_tensor is None:
+      if len(self._input_buffers) >= MAX_INPUT_BUFFERS:
+        self._input_buffers.clear()
+      im_tensor = np.empty((1, 3, key[0], key[1]), dtype=np.float32)
+      self._input_buffers[key] = im_tensor
+    return image_to_tensor(im, im_tensor, self._input_scale, self._input_bias)
+
+  def _get_anchors(self, height, width, stride):
+    """
+    Anchors [K*A 4] of a feature map and their geometry, computed once per (height, width, stride).
+    With a fixed camera resolution this is the same on every frame.
+    """
+    key = (height, width, stride)
+    plane = self._anchor_cache.get(key)
+    if plane is not None:
+      self._anchor_cache.move_to_end(key)
+      return plane
+    anchors_fpn = self._anchors_fpn['stride%s'%stride]
+    A = self._num_anchors['stride%s'%stride]
+    anchors = anchors_plane(height, width, stride, anchors_fpn).reshape((height * width * A, 4))
+    plane = (anchors, anchor_geometry(anchors))
+    self._anchor_cache[key] = plane
+    if len(self._anchor_cache) > MAX_ANCHOR_CACHE:
+      self._anchor_cache.popitem(last=False)
+    return plane
+
+  def _get_module(self, shape):
+    """
+    Return a module bound to the input shape (N, 3, H, W). Binding is done once per shape with the
+    parameters shared with self.model, so changing sizes does not rebind the network on every call.
+    """
+    shape = tuple(shape)
+    mod = self._modules.get(shape)
+    if mod is not None:
+      self._modules.move_to_end(shape)
+      return mod
+    mod = mx.mod.Module(symbol=self.sym, context=self.ctx, label_names = None)
+    mod.bind(data_shapes=[('data', shape)], for_training=False, shared_module=self.model)
+    self._modules[shape] = mod
+    if len(self._modules) > MAX_MODULE_CACHE:
+      for key in self._modules:
+        if self._modules[key] is not self.model:
+          del self._modules[key]
+          break
+    return mod
+
+  def input_shape(self, height, width, im_scale=1.0):
+    """Shape of the input tensor detect() uses for an image of this size"""
+    if im_scale!=1.0:
+      # cv2.resize rounds the scaled size
+      height = int(round(height * im_scale))
+      width = int(round(width * im_scale))
+    if self.nocrop:
+      height = (height + 31) // 32 * 32
+      width = (width + 31) // 32 * 32
+    return (1, 3, height, width)
+
+  def warm_up(self, image_sizes, scales=[1.0]):
+    """
+    Bind and run the network once for every (height, width) in image_sizes at every scale, so the first
+    frames do not stall. Flipped images have the same shape and need nothing more.
+    """
+    for height, width in image_sizes:
+      for im_scale in scales:
+        shape = self.input_shape(height, width, im_scale)
+        data = nd.zeros(shape)
+        db = mx.io.DataBatch(data=(data,), provide_data=[('data', data.shape)])
+        mod = self._get_module(shape)
+        mod.forward(db, is_train=False)
+        for out in mod.get_outputs():
+          out.wait_to_read()
 
   def get_input(self, img):
-    im = img.astype(np.float32)
-    im_tensor = np.zeros((1, 3, im.shape[0], im.shape[1]))
-    for i in range(3):
-        im_tensor[0, i, :, :] = (im[:, :, 2 - i]/self.pixel_scale - self.pixel_means[2 - i])/self.pixel_stds[2-i]
+    im_tensor = self._prepare_tensor(img)
     #if self.debug:
     #  timeb = datetime.datetime.now()
     #  diff = timeb - timea
@@ -163,8 +276,12 @@ class RetinaFace:
       for flip in flips:
         if im_scale!=1.0:
           im = cv2.resize(img, None, None, fx=im_scale, fy=im_scale, interpolation=cv2.INTER_LINEAR)
+          # cv2.resize rounds the size, map back with the real factor of each axis
+          scale_xy = np.array([im.shape[1] / img.shape[1], im.shape[0] / img.shape[0]], dtype=np.float32)
         else:
-          im = img.copy()
+          # the tensor is filled from the image without modifying it, no copy needed
+          im = img
+          scale_xy = np.ones(2, dtype=np.float32)
         if flip:
           im = im[:,::-1,:]
         if self.nocrop:
@@ -179,8 +296,6 @@ class RetinaFace:
           _im = np.zeros( (h, w, 3), dtype=np.float32 )
           _im[0:im.shape[0], 0:im.shape[1], :] = im
           im = _im
-        else:
-          im = im.astype(np.float32)
         if self.debug:
           timeb = datetime.datetime.now()
           diff = timeb - timea
@@ -188,9 +303,7 @@ class RetinaFace:
         #self.model.bind(data_shapes=[('data', (1, 3, image_size[0], image_size[1]))], for_training=False)
         #im_info = [im.shape[0], im.shape[1], im_scale]
         im_info = [im.shape[0], im.shape[1]]
-        im_tensor = np.zeros((1, 3, im.shape[0], im.shape[1]))
-        for i in range(3):
-            im_tensor[0, i, :, :] = (im[:, :, 2 - i]/self.pixel_scale - self.pixel_means[2 - i])/self.pixel_stds[2-i]
+        im_tensor = self._prepare_tensor(im)
         if self.debug:
           timeb = datetime.datetime.now()
           diff = timeb - timea
@@ -201,141 +314,196 @@ class RetinaFace:
           timeb = datetime.datetime.now()
           diff = timeb - timea
           print('X3 uses', diff.total_seconds(), 'seconds')
-        self.model.forward(db, is_train=False)
-        net_out = self.model.get_outputs()
+        mod = self._get_module(data.shape)
+        mod.forward(db, is_train=False)
+        net_out = [out.asnumpy() for out in mod.get_outputs()]
         #post_nms_topN = self._rpn_post_nms_top_n
         #min_size_dict = self._rpn_min_size_fpn
 
-        for _idx,s in enumerate(self._feat_stride_fpn):
-            #if len(scales)>1 and s==32 and im_scale==scales[-1]:
-            #  continue
-            _key = 'stride%s'%s
-            stride = int(s)
-            #if self.vote and stride==4 and len(scales)>2 and (im_scale==scales[0]):
-            #  continue
-            if self.use_landmarks:
-              idx = _idx*3
-            else:
-              idx = _idx*2
-            #print('getting', im_scale, stride, idx, len(net_out), data.shape, file=sys.stderr)
-            scores = net_out[idx].asnumpy()
-            if self.debug:
-              timeb = datetime.datetime.now()
-              diff = timeb - timea
-              print('A uses', diff.total_seconds(), 'seconds')
-            #print(scores.shape)
-            #print('scores',stride, scores.shape, file=sys.stderr)
-            scores = scores[:, self._num_anchors['stride%s'%s]:, :, :]
-
-            idx+=1
-            bbox_deltas = net_out[idx].asnumpy()
-
-            #if DEBUG:
-            #    print 'im_size: ({}, {})'.format(im_info[0], im_info[1])
-            #    print 'scale: {}'.format(im_info[2])
-
-            #_height, _width = int(im_info[0] / stride), int(im_info[1] / stride)
-            height, width = bbox_deltas.shape[2], bbox_deltas.shape[3]
-
-            A = self._num_anchors['stride%s'%s]
-            K = height * width
-            anchors_fpn = self._anchors_fpn['stride%s'%s]
-            anchors = anchors_plane(height, width, stride, anchors_fpn)
-            #print((height, width), (_height, _width), anchors.shape, bbox_deltas.shape, scores.shape, file=sys.stderr)
-            anchors = anchors.reshape((K * A, 4))
-            #print('num_anchors', self._num_anchors['stride%s'%s], file=sys.stderr)
-            #print('HW', (height, width), file=sys.stderr)
-            #print('anchors_fpn', anchors_fpn.shape, file=sys.stderr)
-            #print('anchors', anchors.shape, file=sys.stderr)
-            #print('bbox_deltas', bbox_deltas.shape, file=sys.stderr)
-            #print('scores', scores.shape, file=sys.stderr)
-
-
-            scores = self._clip_pad(scores, (height, width))
-            scores = scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
-
-            #print('pre', bbox_deltas.shape, height, width)
-            bbox_deltas = self._clip_pad(bbox_deltas, (height, width))
-            #print('after', bbox_deltas.shape, height, width)
-            bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1))
-            bbox_pred_len = bbox_deltas.shape[3]//A
-            #print(bbox_deltas.shape)
-            bbox_deltas = bbox_deltas.reshape((-1, bbox_pred_len))
-
-
-            #print(anchors.shape, bbox_deltas.shape, A, K, file=sys.stderr)
-            proposals = self.bbox_pred(anchors, bbox_deltas)
-            proposals = clip_boxes(proposals, im_info[:2])
-
-            #if self.vote:
-            #  if im_scale>1.0:
-            #    keep = self._filter_boxes2(proposals, 160*im_scale, -1)
-            #  else:
-            #    keep = self._filter_boxes2(proposals, -1, 100*im_scale)
-            #  if stride==4:
-            #    keep = self._filter_boxes2(proposals, 12*im_scale, -1)
-            #    proposals = proposals[keep, :]
-            #    scores = scores[keep]
-
-            #keep = self._filter_boxes(proposals, min_size_dict['stride%s'%s] * im_info[2])
-            #proposals = proposals[keep, :]
-            #scores = scores[keep]
-            #print('333', proposals.shape)
-
-            scores_ravel = scores.ravel()
-            #print('__shapes', proposals.shape, scores_ravel.shape)
-            #print('max score', np.max(scores_ravel))
-            order = np.where(scores_ravel>=threshold)[0]
-              #_scores = scores_ravel[order]
-              #_order = _scores.argsort()[::-1]
-              #order = order[_order]
-            proposals = proposals[order, :]
-            scores = scores[order]
-            if stride==4 and self.decay4<1.0:
-              scores *= self.decay4
-            if flip:
-              oldx1 = proposals[:, 0].copy()
-              oldx2 = proposals[:, 2].copy()
-              proposals[:, 0] = im.shape[1] - oldx2 - 1
-              proposals[:, 2] = im.shape[1] - oldx1 - 1
-
-            proposals[:,0:4] /= im_scale
-
-            proposals_list.append(proposals)
-            scores_list.append(scores)
-
-            if not self.vote and self.use_landmarks:
-              idx+=1
-              landmark_deltas = net_out[idx].asnumpy()
-              landmark_deltas = self._clip_pad(landmark_deltas, (height, width))
-              landmark_pred_len = landmark_deltas.shape[1]//A
-              landmark_deltas = landmark_deltas.transpose((0, 2, 3, 1)).reshape((-1, 5, landmark_pred_len//5))
-              #print(landmark_deltas.shape, landmark_deltas)
-              landmarks = self.landmark_pred(anchors, landmark_deltas)
-              landmarks = landmarks[order, :]
-
-              if flip:
-                landmarks[:,:,0] = im.shape[1] - landmarks[:,:,0] - 1
-                #for a in range(5):
-                #  oldx1 = landmarks[:, a].copy()
-                #  landmarks[:,a] = im.shape[1] - oldx1 - 1
-                order = [1,0,2,4,3]
-                flandmarks = landmarks.copy()
-                for idx, a in enumerate(order):
-                  flandmarks[:,idx,:] = landmarks[:,a,:]
-                  #flandmarks[:, idx*2] = landmarks[:,a*2]
-                  #flandmarks[:, idx*2+1] = landmarks[:,a*2+1]
-                landmarks = flandmarks
-              landmarks[:,:,0:2] /= im_scale
-              #landmarks /= im_scale
-              #landmarks = landmarks.reshape( (-1, landmark_pred_len) )
-              landmarks_list.append(landmarks)
-              #proposals = np.hstack((proposals, landmarks))
+        self._decode_outputs(net_out, 0, im_info, threshold, scale_xy, flip,
+                             proposals_list, scores_list, landmarks_list)
 
     if self.debug:
       timeb = datetime.datetime.now()
       diff = timeb - timea
       print('B uses', diff.total_seconds(), 'seconds')
+    det, landmarks = self._finalize(proposals_list, scores_list, landmarks_list)
+
+    if self.debug:
+      timeb = datetime.datetime.now()
+      diff = timeb - timea
+      print('C uses', diff.total_seconds(), 'seconds')
+    return det, landmarks
+
+  def batch_shape(self, images):
+    """Shape of the padded input tensor detect_batch() uses, rounded up to 32 so similar batches share a module"""
+    height = max(im.shape[0] for im in images)
+    width = max(im.shape[1] for im in images)
+    return (len(images), 3, (height + 31) // 32 * 32, (width + 31) // 32 * 32)
+
+  def detect_batch(self, images, threshold=0.5):
+    """
+    Detect faces in several images with one forward pass. The images are placed in the top left
+    corner of a shared padded tensor without resizing, so the coordinates need no correction, and the
+    decoded boxes of each image are clipped to its own size. Returns a list of (det, landmarks).
+    """
+    if len(images)==0:
+      return []
+    shape = self.batch_shape(images)
+    batch = self._input_buffers.get(shape)
+    if batch is None:
+      if len(self._input_buffers) >= MAX_INPUT_BUFFERS:
+        self._input_buffers.clear()
+      batch = np.empty(shape, dtype=np.float32)
+      self._input_buffers[shape] = batch
+    # padding is a black pixel, like the zero padding of the network
+    if self._input_bias is None:
+      batch.fill(0)
+    else:
+      batch[:] = self._input_bias
+    for i, im in enumerate(images):
+      image_to_tensor(im, batch[i:i+1, :, :im.shape[0], :im.shape[1]], self._input_scale, self._input_bias)
+
+    data = nd.array(batch)
+    db = mx.io.DataBatch(data=(data,), provide_data=[('data', data.shape)])
+    mod = self._get_module(data.shape)
+    mod.forward(db, is_train=False)
+    net_out = [out.asnumpy() for out in mod.get_outputs()]
+
+    results = []
+    for i, im in enumerate(images):
+      proposals_list = []
+      scores_list = []
+      landmarks_list = []
+      self._decode_outputs(net_out, i, im.shape[:2], threshold, np.ones(2, dtype=np.float32), 0,
+                           proposals_list, scores_list, landmarks_list)
+      results.append(self._finalize(proposals_list, scores_list, landmarks_list))
+    return results
+
+  def _decode_outputs(self, net_out, b, im_info, threshold, im_scale, flip,
+                      proposals_list, scores_list, landmarks_list):
+    """Decode the network outputs of image b of the batch, net_out are numpy arrays.
+    im_info is the (height, width) of the image inside the input tensor, used for clipping.
+    im_scale is the resize factor of the image, a number or a (x, y) pair"""
+    # (x, y) either way, a scalar would not broadcast against the (n, 4) boxes
+    im_scale = np.broadcast_to(np.asarray(im_scale, dtype=np.float32), (2,))
+    for _idx,s in enumerate(self._feat_stride_fpn):
+        #if len(scales)>1 and s==32 and im_scale==scales[-1]:
+        #  continue
+        _key = 'stride%s'%s
+        stride = int(s)
+        #if self.vote and stride==4 and len(scales)>2 and (im_scale==scales[0]):
+        #  continue
+        if self.use_landmarks:
+          idx = _idx*3
+        else:
+          idx = _idx*2
+        #print('getting', im_scale, stride, idx, len(net_out), file=sys.stderr)
+        scores = net_out[idx][b:b+1]
+        #print(scores.shape)
+        #print('scores',stride, scores.shape, file=sys.stderr)
+        scores = scores[:, self._num_anchors['stride%s'%s]:, :, :]
+
+        idx+=1
+        bbox_deltas = net_out[idx][b:b+1]
+
+        #if DEBUG:
+        #    print 'im_size: ({}, {})'.format(im_info[0], im_info[1])
+        #    print 'scale: {}'.format(im_info[2])
+
+        #_height, _width = int(im_info[0] / stride), int(im_info[1] / stride)
+        height, width = bbox_deltas.shape[2], bbox_deltas.shape[3]
+
+        A = self._num_anchors['stride%s'%s]
+        anchors, geometry = self._get_anchors(height, width, stride)
+        #print((height, width), (_height, _width), anchors.shape, bbox_deltas.shape, scores.shape, file=sys.stderr)
+        #print('num_anchors', self._num_anchors['stride%s'%s], file=sys.stderr)
+        #print('HW', (height, width), file=sys.stderr)
+        #print('anchors_fpn', anchors_fpn.shape, file=sys.stderr)
+        #print('anchors', anchors.shape, file=sys.stderr)
+        #print('bbox_deltas', bbox_deltas.shape, file=sys.stderr)
+        #print('scores', scores.shape, file=sys.stderr)
+
+
+        scores = self._clip_pad(scores, (height, width))
+        scores = scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
+
+        #print('pre', bbox_deltas.shape, height, width)
+        bbox_deltas = self._clip_pad(bbox_deltas, (height, width))
+        #print('after', bbox_deltas.shape, height, width)
+        bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1))
+        bbox_pred_len = bbox_deltas.shape[3]//A
+        #print(bbox_deltas.shape)
+        bbox_deltas = bbox_deltas.reshape((-1, bbox_pred_len))
+
+        # apply the score threshold first, only the surviving anchors are decoded
+        scores_ravel = scores.ravel()
+        order = np.where(scores_ravel>=threshold)[0]
+        scores = scores[order]
+        anchors = anchors[order]
+        geometry = tuple(g[order] for g in geometry)
+
+        #print(anchors.shape, bbox_deltas.shape, A, K, file=sys.stderr)
+        proposals = self.bbox_pred(anchors, bbox_deltas[order], geometry)
+        proposals = clip_boxes(proposals, im_info[:2])
+
+        #if self.vote:
+        #  if im_scale>1.0:
+        #    keep = self._filter_boxes2(proposals, 160*im_scale, -1)
+        #  else:
+        #    keep = self._filter_boxes2(proposals, -1, 100*im_scale)
+        #  if stride==4:
+        #    keep = self._filter_boxes2(proposals, 12*im_scale, -1)
+        #    proposals = proposals[keep, :]
+        #    scores = scores[keep]
+
+        #keep = self._filter_boxes(proposals, min_size_dict['stride%s'%s] * im_info[2])
+        #proposals = proposals[keep, :]
+        #scores = scores[keep]
+        #print('333', proposals.shape)
+
+        if stride==4 and self.decay4<1.0:
+          scores *= self.decay4
+        if flip:
+          oldx1 = proposals[:, 0].copy()
+          oldx2 = proposals[:, 2].copy()
+          proposals[:, 0] = im_info[1] - oldx2 - 1
+          proposals[:, 2] = im_info[1] - oldx1 - 1
+
+        proposals[:,0:4] /= np.tile(im_scale, 2)
+
+        proposals_list.append(proposals)
+        scores_list.append(scores)
+
+        if not self.vote and self.use_landmarks:
+          idx+=1
+          landmark_deltas = net_out[idx][b:b+1]
+          landmark_deltas = self._clip_pad(landmark_deltas, (height, width))
+          landmark_pred_len = landmark_deltas.shape[1]//A
+          landmark_deltas = landmark_deltas.transpose((0, 2, 3, 1)).reshape((-1, 5, landmark_pred_len//5))
+          #print(landmark_deltas.shape, landmark_deltas)
+          landmarks = self.landmark_pred(anchors, landmark_deltas[order], geometry)
+
+          if flip:
+            landmarks[:,:,0] = im_info[1] - landmarks[:,:,0] - 1
+            #for a in range(5):
+            #  oldx1 = landmarks[:, a].copy()
+            #  landmarks[:,a] = im_info[1] - oldx1 - 1
+            order = [1,0,2,4,3]
+            flandmarks = landmarks.copy()
+            for idx, a in enumerate(order):
+              flandmarks[:,idx,:] = landmarks[:,a,:]
+              #flandmarks[:, idx*2] = landmarks[:,a*2]
+              #flandmarks[:, idx*2+1] = landmarks[:,a*2+1]
+            landmarks = flandmarks
+          landmarks[:,:,0:2] /= im_scale
+          #landmarks /= im_scale
+          #landmarks = landmarks.reshape( (-1, landmark_pred_len) )
+          landmarks_list.append(landmarks)
+          #proposals = np.hstack((proposals, landmarks))
+
+  def _finalize(self, proposals_list, scores_list, landmarks_list):
+    """Sort and suppress the decoded proposals of one image"""
     proposals = np.vstack(proposals_list)
     landmarks = None
     if proposals.shape[0]==0:
@@ -367,11 +535,6 @@ class RetinaFace:
       det = self.bbox_vote(det)
     #if self.use_landmarks:
     #  det = np.hstack((det, landmarks))
-
-    if self.debug:
-      timeb = datetime.datetime.now()
-      diff = timeb - timea
-      print('C uses', diff.total_seconds(), 'seconds')
     return det, landmarks
 
   def detect_center(self, img, threshold=0.5, scales=[1.0], do_flip=False):
@@ -500,22 +663,22 @@ class RetinaFace:
       return tensor
 
   @staticmethod
-  def bbox_pred(boxes, box_deltas):
+  def bbox_pred(boxes, box_deltas, geometry=None):
       """
       Transform the set of class-agnostic boxes into class-specific boxes
       by applying the predicted offsets (box_deltas)
       :param boxes: !important [N 4]
       :param box_deltas: [N, 4 * num_classes]
+      :param geometry: precomputed anchor_geometry(boxes), optional
       :return: [N 4 * num_classes]
       """
       if boxes.shape[0] == 0:
           return np.zeros((0, box_deltas.shape[1]))
 
-      boxes = boxes.astype(np.float, copy=False)
-      widths = boxes[:, 2] - boxes[:, 0] + 1.0
-      heights = boxes[:, 3] - boxes[:, 1] + 1.0
-      ctr_x = boxes[:, 0] + 0.5 * (widths - 1.0)
-      ctr_y = boxes[:, 1] + 0.5 * (heights - 1.0)
+      if geometry is None:
+        boxes = boxes.astype(np.float32, copy=False)
+        geometry = anchor_geometry(boxes)
+      widths, heights, ctr_x, ctr_y = geometry
 
       dx = box_deltas[:, 0:1]
       dy = box_deltas[:, 1:2]
@@ -527,7 +690,7 @@ class RetinaFace:
       pred_w = np.exp(dw) * widths[:, np.newaxis]
       pred_h = np.exp(dh) * heights[:, np.newaxis]
 
-      pred_boxes = np.zeros(box_deltas.shape)
+      pred_boxes = np.zeros(box_deltas.shape, dtype=np.float32)
       # x1
       pred_boxes[:, 0:1] = pred_ctr_x - 0.5 * (pred_w - 1.0)
       # y1
@@ -543,18 +706,17 @@ class RetinaFace:
       return pred_boxes
 
   @staticmethod
-  def landmark_pred(boxes, landmark_deltas):
+  def landmark_pred(boxes, landmark_deltas, geometry=None):
       if boxes.shape[0] == 0:
-          return np.zeros((0, landmark_deltas.shape[1]))
-      boxes = boxes.astype(np.float, copy=False)
-      widths = boxes[:, 2] - boxes[:, 0] + 1.0
-      heights = boxes[:, 3] - boxes[:, 1] + 1.0
-      ctr_x = boxes[:, 0] + 0.5 * (widths - 1.0)
-      ctr_y = boxes[:, 1] + 0.5 * (heights - 1.0)
-      pred = landmark_deltas.copy()
-      for i in range(5):
-        pred[:,i,0] = landmark_deltas[:,i,0]*widths + ctr_x
-        pred[:,i,1] = landmark_deltas[:,i,1]*heights + ctr_y
+          return np.zeros((0,) + landmark_deltas.shape[1:], dtype=np.float32)
+      if geometry is None:
+        boxes = boxes.astype(np.float32, copy=False)
+        geometry = anchor_geometry(boxes)
+      widths, heights, ctr_x, ctr_y = geometry
+      # all 5 points at once
+      pred = landmark_deltas.astype(np.float32)
+      pred[:,:,0] = landmark_deltas[:,:,0]*widths[:, np.newaxis] + ctr_x[:, np.newaxis]
+      pred[:,:,1] = landmark_deltas[:,:,1]*heights[:, np.newaxis] + ctr_y[:, np.newaxis]
       return pred
       #preds = []
       #for i in range(landmark_deltas.shape[1]):
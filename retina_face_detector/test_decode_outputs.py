@@ -0,0 +1,74 @@
+"""Smoke test of RetinaFace._decode_outputs on made up network outputs, no model needed.
+
+Usage: python3 test_decode_outputs.py"""
+
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+
+from rcnn.processing.generate_anchor import generate_anchors_fpn
+from retinaface import RetinaFace
+
+HEIGHT = 64
+WIDTH = 96
+
+
+def make_detector():
+    """A net3 RetinaFace with the anchors set up and no network"""
+    detector = RetinaFace.__new__(RetinaFace)
+    detector._feat_stride_fpn = [32, 16, 8]
+    detector.fpn_keys = ['stride%s' % s for s in detector._feat_stride_fpn]
+    anchor_cfg = {
+        '32': {'SCALES': (32, 16), 'BASE_SIZE': 16, 'RATIOS': (1.,), 'ALLOWED_BORDER': 9999},
+        '16': {'SCALES': (8, 4), 'BASE_SIZE': 16, 'RATIOS': (1.,), 'ALLOWED_BORDER': 9999},
+        '8': {'SCALES': (2, 1), 'BASE_SIZE': 16, 'RATIOS': (1.,), 'ALLOWED_BORDER': 9999},
+    }
+    anchors = generate_anchors_fpn(dense_anchor=False, cfg=anchor_cfg)
+    detector._anchors_fpn = dict(zip(detector.fpn_keys, [a.astype(np.float32) for a in anchors]))
+    detector._num_anchors = dict(zip(detector.fpn_keys, [a.shape[0] for a in detector._anchors_fpn.values()]))
+    detector._anchor_cache = OrderedDict()
+    detector.use_landmarks = True
+    detector.vote = False
+    detector.decay4 = 0.5
+    return detector
+
+
+def make_outputs(detector):
+    """Scores, box and landmark deltas of each stride, one confident anchor in the stride 16 map"""
+    net_out = []
+    for s in detector._feat_stride_fpn:
+        A = detector._num_anchors['stride%s' % s]
+        h, w = HEIGHT // s, WIDTH // s
+        scores = np.zeros((1, 2 * A, h, w), dtype=np.float32)
+        if s == 16:
+            scores[0, A, 1, 2] = 0.9
+        net_out.append(scores)
+        net_out.append(np.zeros((1, 4 * A, h, w), dtype=np.float32))
+        net_out.append(np.zeros((1, 10 * A, h, w), dtype=np.float32))
+    return net_out
+
+
+class DecodeOutputsTest(unittest.TestCase):
+
+    def decode(self, im_scale):
+        detector = make_detector()
+        proposals_list, scores_list, landmarks_list = [], [], []
+        detector._decode_outputs(make_outputs(detector), 0, (HEIGHT, WIDTH), 0.5, im_scale, 0,
+                                 proposals_list, scores_list, landmarks_list)
+        return np.vstack(proposals_list), np.vstack(landmarks_list)
+
+    def test_scalar_scale(self):
+        proposals, landmarks = self.decode(1.0)
+        self.assertEqual(proposals.shape, (1, 4))
+        self.assertEqual(landmarks.shape, (1, 5, 2))
+
+    def test_pair_scale(self):
+        proposals, landmarks = self.decode(1.0)
+        scaled, scaled_landmarks = self.decode(np.array([0.5, 0.25], dtype=np.float32))
+        np.testing.assert_allclose(scaled, proposals * [2, 4, 2, 4], rtol=1e-5)
+        np.testing.assert_allclose(scaled_landmarks, landmarks * [2, 4], rtol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""Run the detectors only on the part of the frame with motion."""
+
+from collections import OrderedDict
+
+import numpy as np
+
+import config_main
+
+ROI_DETECTION = config_main.data['ROI_DETECTION']
+# pixels added around the motion region, so people at its border are not cut
+ROI_PADDING = config_main.data['ROI_PADDING']
+# every K-th detected frame is processed in full, so objects that stopped moving are found again
+ROI_FULL_FRAME_INTERVAL = config_main.data['ROI_FULL_FRAME_INTERVAL']
+# crops have one of these sizes, as parts of the frame width and height rounded up to ROI_ALIGN, so the
+# networks only ever see len(ROI_SIZES) + 1 input shapes and their per-shape caches stay warm.
+# Above the largest, 0.56 of the frame, cropping saves little and the full frame is used
+ROI_SIZES = (0.25, 0.5, 0.75)
+ROI_ALIGN = 32
+
+
+def _bucket(size, part):
+    return min(size, int(np.ceil(size * part / ROI_ALIGN)) * ROI_ALIGN)
+
+
+def _place(start, end, length, size):
+    """Start of a crop of length centred on [start, end) inside [0, size)"""
+    start = start - (length - (end - start)) // 2
+    return max(0, min(start, size - length))
+
+
+class RoiSelector:
+    """Choose the crop of each frame to run detection on and shift the results back to frame coordinates"""
+
+    def __init__(self, enabled=ROI_DETECTION, padding=ROI_PADDING, full_frame_interval=ROI_FULL_FRAME_INTERVAL):
+        self.enabled = enabled
+        self.padding = padding
+        self.full_frame_interval = max(1, full_frame_interval)
+        self.count = 0
+        # (x, y) offset of the crop of each frame waiting for its result
+        self.offsets = dict()
+
+    def select(self, frame_id, frame, regions):
+        """Return the image to detect on for a frame with the motion regions [(x, y, w, h, ...)]"""
+        offset = (0, 0)
+        image = frame
+        if self.enabled and len(regions) > 0 and self.count % self.full_frame_interval != 0:
+            frame_h, frame_w = frame.shape[:2]
+            l = max(0, min(region[0] for region in regions) - self.padding)
+            t = max(0, min(region[1] for region in regions) - self.padding)
+            r = min(frame_w, max(region[0] + region[2] for region in regions) + self.padding)
+            b = min(frame_h, max(region[1] + region[3] for region in regions) + self.padding)
+            for part in ROI_SIZES:
+                crop_w, crop_h = _bucket(frame_w, part), _bucket(frame_h, part)
+                if crop_w >= r - l and crop_h >= b - t:
+                    l = _place(l, r, crop_w, frame_w)
+                    t = _place(t, b, crop_h, frame_h)
+                    image = frame[t:t + crop_h, l:l + crop_w]
+                    offset = (l, t)
+                    break
+        self.count += 1
+        self.offsets[frame_id] = offset
+        return image
+
+    @staticmethod
+    def shapes(frame_shape):
+        """Every (height, width) select() can return for frames of frame_shape, to warm up the detectors"""
+        frame_h, frame_w = frame_shape[:2]
+        shapes = [(_bucket(frame_h, part), _bucket(frame_w, part)) for part in ROI_SIZES]
+        shapes.append((frame_h, frame_w))
+        return list(OrderedDict.fromkeys(shapes))
+
+    def pop_offset(self, frame_id):
+        """Offset of the crop of a frame that got its result, older frames will never get one"""
+        offset = self.offsets.pop(frame_id, (0, 0))
+        for fid in [fid for fid in self.offsets if fid < frame_id]:
+            del self.offsets[fid]
+        return offset
+
+    @staticmethod
+    def shift_boxes(boxes, offset):
+        """Move boxes (n, >=4) as (left, top, right, bottom, ...) by offset (x, y)"""
+        if offset == (0, 0) or len(boxes) == 0:
+            return boxes
+        boxes = np.array(boxes, dtype=np.float32)
+        boxes[:, [0, 2]] += offset[0]
+        boxes[:, [1, 3]] += offset[1]
+        return boxes
+
+    @staticmethod
+    def shift_points(points, offset):
+        """Move landmarks (n, 5, 2) by offset (x, y)"""
+        if offset == (0, 0) or len(points) == 0:
+            return points
+        return points + np.array(offset, dtype=points.dtype)
@@ -0,0 +1,39 @@
+"""Run the counting, heatmap, storage and upload of the store without the GUI, for servers and containers.
+
+Usage: python3 run_headless.py [--config data_main/config.json] [--no-human] [--no-face]
+
+Stops on Ctrl-C or SIGTERM, after saving what was processed."""
+
+import argparse
+import os
+import signal
+
+import config_main
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the pipelines without the GUI')
+    parser.add_argument('--config', default=None, help='config file, data_main/config.json by default')
+    parser.add_argument('--no-human', action='store_true', help='do not run the people counting and heatmap')
+    parser.add_argument('--no-face', action='store_true', help='do not run the face analysis')
+    args = parser.parse_args()
+
+    if args.config is not None:
+        # the modules read the config when they are imported
+        config_main.load(os.path.realpath(args.config))
+    from pipeline import Engine
+
+    engine = Engine(human=not args.no_human, face=not args.no_face)
+
+    def on_signal(signum, frame):
+        print('Stopping')
+        for pipeline in engine.pipelines():
+            pipeline.stop()
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    engine.start()
+    # join with a timeout so the signals are handled
+    while engine.is_running():
+        engine.wait(1.0)
+    engine.stop()
@@ -43,6 +43,7 @@ class DataStorage:
             self.create_db()
         else:
             self.connection = sqlite3.connect(DATABASE, detect_types=1)
+        self.create_missing_tables()
 
     def create_db(self):
         c = self.connection.cursor()
@@ -86,6 +87,36 @@ class DataStorage:
             PRIMARY KEY (year, month))''')
         self.connection.commit()
 
+    def create_missing_tables(self):
+        """Tables added after the first release, databases created before do not have them"""
+        c = self.connection.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS heatmap_bucket (
+            period TEXT,
+            year INTEGER,
+            month INTEGER,
+            day INTEGER,
+            hour INTEGER,
+            count INTEGER,
+            scale REAL,
+            heatmap ARRAY,
+            thumbnail ARRAY,
+            PRIMARY KEY (period, year, month, day, hour))''')
+        # running sums of the hour heatmaps of a day (day = 0 for months: sums of the day heatmaps),
+        # members is the bit set of the hours (days) in the sum, dirty ones are not finished yet
+        c.execute('''CREATE TABLE IF NOT EXISTS heatmap_rollup (
+            period TEXT,
+            year INTEGER,
+            month INTEGER,
+            day INTEGER,
+            heatmap ARRAY,
+            count INTEGER,
+            members INTEGER,
+            frame_day INTEGER,
+            frame_hour INTEGER,
+            dirty INTEGER,
+            PRIMARY KEY (period, year, month, day))''')
+        self.connection.commit()
+
     def insert_into_hour_data(self, year, month, day, hour, data):
         count = data['count']
         wait_time = data['wait_time']
@@ -96,9 +127,9 @@ class DataStorage:
         age2 = data['age2']
         age3 = data['age3']
         age4 = data['age4']
-        heatmap = data['heatmap']
+        # the heatmap of the hour is in heatmap_bucket, the column only has the hours saved before it
         frame = data['frame']
-        values = (year, month, day, hour, count, wait_time, stay_time, male, female, age1, age2, age3, age4, heatmap, frame)
+        values = (year, month, day, hour, count, wait_time, stay_time, male, female, age1, age2, age3, age4, None, frame)
         c = self.connection.cursor()
         c.execute('INSERT OR REPLACE INTO hour_data VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', values)
         self.connection.commit()
@@ -110,6 +141,63 @@ class DataStorage:
         data = c.fetchall()
         return data
 
+    def get_hour_keys(self):
+        c = self.connection.cursor()
+        c.execute('SELECT year, month, day, hour FROM hour_data UNION '
+                  'SELECT year, month, day, hour FROM heatmap_bucket WHERE period=\'hour\'')
+        data = c.fetchall()
+        return data
+
+    def get_hour_heatmap(self, year, month, day, hour):
+        """Mean heatmap of an hour and whether it has a frame, without loading the frame"""
+        c = self.connection.cursor()
+        values = (year, month, day, hour)
+        c.execute('SELECT heatmap, frame IS NOT NULL FROM hour_data WHERE year=? AND month=? AND day=? AND hour=?',
+                  values)
+        data = c.fetchall()
+        heatmap, has_frame = data[0] if len(data) > 0 else (None, False)
+        c.execute('SELECT count, scale, heatmap FROM heatmap_bucket '
+                  'WHERE period=\'hour\' AND year=? AND month=? AND day=? AND hour=?', values)
+        bucket = c.fetchall()
+        if len(bucket) > 0:
+            count, scale, levels = bucket[0]
+            heatmap = levels.astype('float32') * (scale / count) if count > 0 else None
+        elif len(data) == 0:
+            return []
+        return [(heatmap, has_frame)]
+
+    def get_heatmap_hours(self, year, month, day, thumbnail=True):
+        """hour -> mean heatmap of the hours of a day in heatmap_bucket, the small pyramid level by default"""
+        c = self.connection.cursor()
+        values = (year, month, day)
+        c.execute('SELECT hour, count, scale, {} FROM heatmap_bucket '
+                  'WHERE period=\'hour\' AND year=? AND month=? AND day=?'.format(
+                      'thumbnail' if thumbnail else 'heatmap'), values)
+        heatmaps = dict()
+        for hour, count, scale, levels in c.fetchall():
+            if count > 0:
+                heatmaps[hour] = levels.astype('float32') * (scale / count)
+        return heatmaps
+
+    def get_hour_frame(self, year, month, day, hour):
+        c = self.connection.cursor()
+        values = (year, month, day, hour)
+        c.execute('SELECT frame FROM hour_data WHERE year=? AND month=? AND day=? AND hour=?', values)
+        data = c.fetchall()
+        return data
+
+    def get_last_frame(self, year, month, day=None):
+        """Frame of the last hour of a day, or of a month, that has one"""
+        c = self.connection.cursor()
+        if day is None:
+            c.execute('SELECT frame FROM hour_data WHERE year=? AND month=? AND frame IS NOT NULL '
+                      'ORDER BY day DESC, hour DESC LIMIT 1', (year, month))
+        else:
+            c.execute('SELECT frame FROM hour_data WHERE year=? AND month=? AND day=? AND frame IS NOT NULL '
+                      'ORDER BY hour DESC LIMIT 1', (year, month, day))
+        data = c.fetchall()
+        return data
+
     def get_day_data(self, year, month, day):
         c = self.connection.cursor()
         values = (year, month, day)
@@ -181,3 +269,49 @@ class DataStorage:
         c.execute('SELECT heatmap FROM heatmap_month WHERE year=? AND month=?', values)
         data = c.fetchall()
         return data
+
+    def set_heatmap_bucket(self, period, year, month, day, hour, count, scale, heatmap, thumbnail):
+        c = self.connection.cursor()
+        values = (period, year, month, day, hour, count, scale, heatmap, thumbnail)
+        c.execute('INSERT OR REPLACE INTO heatmap_bucket VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', values)
+        self.connection.commit()
+
+    def get_heatmap_bucket(self, period, year, month, day, hour):
+        c = self.connection.cursor()
+        values = (period, year, month, day, hour)
+        c.execute('SELECT count, scale, heatmap, thumbnail FROM heatmap_bucket '
+                  'WHERE period=? AND year=? AND month=? AND day=? AND hour=?', values)
+        data = c.fetchall()
+        return data
+
+    def set_rollup(self, period, year, month, day, heatmap, count, members, frame_day, frame_hour, dirty):
+        c = self.connection.cursor()
+        values = (period, year, month, day, heatmap, count, members, frame_day, frame_hour, dirty)
+        c.execute('INSERT OR REPLACE INTO heatmap_rollup VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', values)
+        self.connection.commit()
+
+    def get_rollup(self, period, year, month, day):
+        c = self.connection.cursor()
+        values = (period, year, month, day)
+        c.execute('SELECT heatmap, count, members, frame_day, frame_hour, dirty FROM heatmap_rollup '
+                  'WHERE period=? AND year=? AND month=? AND day=?', values)
+        data = c.fetchall()
+        return data
+
+    def get_rollup_members(self, period):
+        c = self.connection.cursor()
+        c.execute('SELECT year, month, day, members FROM heatmap_rollup WHERE period=?', (period,))
+        data = c.fetchall()
+        return data
+
+    def get_dirty_rollups(self):
+        c = self.connection.cursor()
+        c.execute('SELECT period, year, month, day FROM heatmap_rollup WHERE dirty=1')
+        data = c.fetchall()
+        return data
+
+    def set_rollup_clean(self, period, year, month, day):
+        c = self.connection.cursor()
+        values = (period, year, month, day)
+        c.execute('UPDATE heatmap_rollup SET dirty=0 WHERE period=? AND year=? AND month=? AND day=?', values)
+        self.connection.commit()
@@ -20,10 +20,13 @@ def box_dis(box1, box2):
 
 
 class SimpleTracker:
-    def __init__(self, max_age=2.0):
+    def __init__(self, max_age=2.0, clock=time.time):
         self.tracked_item = []
         self.max_age = max_age  # in seconds
         self.total_sequence = 0
+        # time source, the video time when replaying a recording
+        self.clock = clock
+        self.last_id = None
 
     def alive_items(self):
         return self.tracked_item
@@ -34,7 +37,15 @@ class SimpleTracker:
     def total_sequence_count(self):
         return self.total_sequence
 
+    def _new_id(self, now):
+        # ids are creation times, several items created at the same video time still need distinct ids
+        if self.last_id is not None and now <= self.last_id:
+            now = self.last_id + 1e-6
+        self.last_id = now
+        return now
+
     def update(self, list_boxes):
+        now = self.clock()
         ret_ids = [None for _ in range(len(list_boxes))]  # id for each box in list_boxes
         list_tracked_boxes = [item['box'] for item in self.tracked_item]
 
@@ -52,10 +63,10 @@ class SimpleTracker:
         for overlap, i, j in overlap_list:
             if i not in list_match and j not in list_tracked_match:
                 item = self.tracked_item[j]
-                if time.time() - item['last_time'] < self.max_age:
+                if now - item['last_time'] < self.max_age:
                     list_match.append(i)
                     list_tracked_match.append(j)
-                    item['last_time'] = time.time()
+                    item['last_time'] = now
                     item['box'] = list_boxes[i]
                     new_track_list.append(item)
                     ret_ids[i] = item['id']
@@ -63,7 +74,8 @@ class SimpleTracker:
         for i in range(len(list_boxes)):
             if i not in list_match:
                 item = dict()
-                item['id'] = item['first_time'] = item['last_time'] = time.time()
+                item['id'] = self._new_id(now)
+                item['first_time'] = item['last_time'] = now
                 item['box'] = list_boxes[i]
                 new_track_list.append(item)
                 ret_ids[i] = item['id']
@@ -72,7 +84,7 @@ class SimpleTracker:
         for j in range(len(self.tracked_item)):
             if j not in list_tracked_match:
                 item = self.tracked_item[j]
-                if time.time() - item['last_time'] < self.max_age:
+                if now - item['last_time'] < self.max_age:
                     new_track_list.append(item)
                 else:
                     if item['last_time'] - item['first_time'] > MIN_LIVE_TIME:
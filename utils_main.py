@@ -2,10 +2,10 @@ import logging
 import math
 import random
 import string
+import threading
 
 import cv2
 import numpy as np
-import tensorflow as tf
 from google.protobuf import text_format
 from numba import jit
 
@@ -33,6 +33,33 @@ def any_overlap(box, list_boxes, threshold=0.5):
     return False
 
 
+def iou_matrix(boxes1, boxes2):
+    """Intersection over union of every pair of boxes, boxes are (n, 4) arrays of (left, top, right, bottom)"""
+    boxes1 = np.asarray(boxes1, dtype=np.float32).reshape(-1, 4)
+    boxes2 = np.asarray(boxes2, dtype=np.float32).reshape(-1, 4)
+    l = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    t = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    r = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    b = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    s_i = np.maximum(r - l, 0) * np.maximum(b - t, 0)
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    s_u = area1[:, None] + area2[None, :] - s_i
+    return np.divide(s_i, s_u, out=np.zeros_like(s_i), where=s_u > 0)
+
+
+def suppress_overlaps(boxes, threshold=0.5):
+    """Vectorized version of any_overlap over a whole list: boxes are sorted by score, a box is
+    dropped if it overlaps a kept box with a higher score. Return a boolean mask of kept boxes"""
+    ious = iou_matrix(boxes, boxes)
+    n = ious.shape[0]
+    keep = np.ones(n, dtype=bool)
+    for i in range(n):
+        if keep[i]:
+            keep[i + 1:] &= ious[i, i + 1:] <= threshold
+    return keep
+
+
 def _validate_label_map(label_map):
     for item in label_map.item:
         if item.id < 0:
@@ -43,7 +70,7 @@ def _validate_label_map(label_map):
 
 
 def load_labelmap(path):
-    with tf.gfile.GFile(path, 'r') as fid:
+    with open(path, 'r') as fid:
         label_map_string = fid.read()
         label_map = string_int_label_map_pb2.StringIntLabelMap()
         try:
@@ -131,7 +158,56 @@ def resize_max_size(img, max_w, max_h):
             return resize_by_height(img, max_h)
 
 
+def hue_lut():
+    """BGR colour of the 256 hues at full saturation and value, for cv2.LUT"""
+    hsv = np.full((1, 256, 3), 255, dtype='uint8')
+    hsv[0, :, 0] = np.arange(256)
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+
+
+class HeatmapBlender:
+    """Blend a heatmap over frames with lookup tables. With a version, the colourised heatmap at frame size is kept
+    for the next frames until the version, power or frame size changes, give a new version for every new heatmap"""
+
+    def __init__(self):
+        # (version, power, frame size) of the colourised heatmap
+        self.key = None
+        self.lut = hue_lut()
+        self.color = None
+        self.heat_weight = None
+        self.frame_weight = None
+
+    def blend(self, frame, hmap, power=1, version=None):
+        key = (version, power, frame.shape[:2])
+        if version is None or key != self.key:
+            self._prepare(hmap, power, frame.shape[1], frame.shape[0])
+            self.key = key
+        return cv2.blendLinear(frame, self.color, self.frame_weight, self.heat_weight)
+
+    def _prepare(self, hmap, power, width, height):
+        # the same steps as blend_heatmap_legacy: hue and weight at heatmap size, then the colour image and the
+        # weights are resized. A hue step is up to 8 levels of a colour channel, so the hue is not quantized
+        if power != 1:
+            hmap = np.power(hmap, power)
+        hue = (120 - hmap * 120).astype('uint8')
+        self.color = cv2.resize(cv2.LUT(cv2.merge([hue, hue, hue]), self.lut), (width, height))
+        self.heat_weight = cv2.resize(hmap.astype('float32'), (width, height))
+        self.frame_weight = 1 - self.heat_weight
+
+
+# keeps the lookup table between the calls, the GUI and the heatmap upload call it from their own threads
+_blender = HeatmapBlender()
+_blender_lock = threading.Lock()
+
+
 def blend_heatmap(frame, hmap, power):
+    with _blender_lock:
+        return _blender.blend(frame, hmap, power)
+
+
+def blend_heatmap_legacy(frame, hmap, power):
+    """Per pixel blending, kept for benchmark_heatmap.py. blend_heatmap differs by at most 1 level, it rounds
+    where this truncates"""
     if power != 1:
         hmap = np.power(hmap, power)
     hmap_hsv = 120 - hmap * 120
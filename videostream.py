@@ -4,17 +4,57 @@ import time
 
 import cv2
 
+import config_main
+
+# ask the FFmpeg backend for hardware decoding, needs OpenCV 4.5.2 or newer
+HW_DECODE = config_main.data['VIDEO_DECODE_HW']
+# decode at most this many frames per second, the others are only grabbed, 0 decodes every frame
+DECODE_FPS = config_main.data['VIDEO_DECODE_FPS']
+# decode a frame only when the consumer waits for one (or decode_fps is due), the others are only grabbed
+CONSUMER_PACED = config_main.data['VIDEO_CONSUMER_PACED']
+# GStreamer pipeline ending in appsink, with {uri}, {width} and {height} placeholders, empty to use the uri
+DECODE_PIPELINE = config_main.data['VIDEO_DECODE_PIPELINE']
+# reopen live streams (cameras, rtsp) that fail instead of ending them
+RECONNECT = config_main.data['VIDEO_RECONNECT']
+# a live stream that gives no frame, or the same frame, for this long is reopened
+STALE_SECONDS = config_main.data['VIDEO_STALE_SECONDS']
+RECONNECT_MIN_DELAY = 1.0
+RECONNECT_MAX_DELAY = 30.0
+
 
 class QueuedStream:
 
-    def __init__(self, uri, drop=True, fps=25):
+    def __init__(self, uri, drop=True, fps=25, decode_size=None, decode_fps=DECODE_FPS,
+                 pipeline=DECODE_PIPELINE, hw_decode=HW_DECODE, consumer_paced=CONSUMER_PACED,
+                 reconnect=RECONNECT, stale_seconds=STALE_SECONDS, replay_start=None):
         self.uri = uri
         self.queue = queue.Queue(maxsize=1)
         self.lock_started = threading.Lock()
+        self.th = None
         self.fps = fps
         self.opened = False
         self.stopped = False
         self.drop = drop
+        # (max width, max height) the frames are needed at, the backend is asked for it when it can scale
+        self.decode_size = decode_size
+        self.decode_fps = decode_fps
+        self.pipeline = pipeline
+        self.hw_decode = hw_decode
+        self.consumer_paced = consumer_paced
+        self.consumer_waiting = threading.Event()
+        self.reconnect = reconnect
+        self.stale_seconds = stale_seconds
+        self.live = len(uri) == 0 or uri.startswith('rtsp://')
+        # replaying a file: no pacing, frame timestamps are replay_start plus the position in the video
+        self.replay_start = replay_start
+        # health metrics
+        self.decoded_count = 0
+        self.grabbed_count = 0
+        self.dropped_count = 0
+        self.reconnect_count = 0
+        self.connected = False
+        self.last_frame_time = None
+        self.decode_rate = 0.0
 
     def start(self):
         self.lock_started.acquire()
@@ -23,22 +63,37 @@ class QueuedStream:
         self.th.start()
         self.lock_started.acquire()
 
-    def read(self):
-        if not self.stopped:
-            frame, frame_id = self.queue.get(True)
-            if frame is None:
-                return (False, None, None)
-            return (True, frame, frame_id)
-        else:
-            return (False, None, None)
-
-    def stop(self):
-        if not self.stopped:
-            self.stopped = True
+    def read(self, with_timestamp=False):
+        """Return (ret, frame, frame_id), and the capture time of the frame with with_timestamp.
+        Live streams are reconnected meanwhile, ret is False only at the end of a file or after stop"""
+        frame = None
+        while not self.stopped:
             try:
-                self.queue.get(False)
-            except Exception:
-                pass
+                frame, frame_id, timestamp = self.queue.get(False)
+            except queue.Empty:
+                # in consumer paced mode the next grabbed frame is decoded for us
+                self.consumer_waiting.set()
+                try:
+                    frame, frame_id, timestamp = self.queue.get(True, 0.5)
+                except queue.Empty:
+                    continue
+            break
+        # a frame put between the empty get and set() would leave it set and the next grab decoded for nothing
+        self.consumer_waiting.clear()
+        if frame is None:
+            return (False, None, None, None) if with_timestamp else (False, None, None)
+        return (True, frame, frame_id, timestamp) if with_timestamp else (True, frame, frame_id)
+
+    def stop(self, wait=True):
+        """Stop the capture, read() returns at once. Safe to call from any thread, wait=False does not wait for
+        the capture thread, which may be blocked opening or grabbing from a dead camera for stale_seconds"""
+        self.stopped = True
+        try:
+            # the capture thread may wait to put a frame
+            self.queue.get(False)
+        except Exception:
+            pass
+        if wait and self.th is not None and self.th is not threading.current_thread():
             self.th.join()
 
     def isOpened(self):
@@ -50,64 +105,180 @@ class QueuedStream:
     def estimate_framerate(self):
         return self.fps
 
-    def _thread_func(self):
-        '''keep looping infinitely'''
-        global IMAGE_W, IMAGE_H, SCALE_RATIO
+    def get_stats(self):
+        """Health of the stream"""
+        stats = dict()
+        stats['connected'] = self.connected
+        stats['decode_fps'] = self.decode_rate
+        stats['grabbed'] = self.grabbed_count
+        stats['decoded'] = self.decoded_count
+        # decoded but replaced by a newer frame before anybody read it
+        stats['dropped'] = self.dropped_count
+        stats['reconnects'] = self.reconnect_count
+        # seconds since the last frame came from the capture
+        stats['last_frame_age'] = time.time() - self.last_frame_time if self.last_frame_time is not None else None
+        return stats
+
+    def _should_decode(self, now, last_decode):
+        """Decode the frame just grabbed or skip it"""
+        if not self.drop:
+            return True
+        if self.consumer_paced and self.consumer_waiting.is_set():
+            return True
+        if self.decode_fps > 0:
+            return last_decode is None or now - last_decode >= 1.0 / self.decode_fps
+        return not self.consumer_paced
+
+    def _open(self):
+        if self.pipeline:
+            width, height = self.decode_size if self.decode_size is not None else (-1, -1)
+            return cv2.VideoCapture(self.pipeline.format(uri=self.uri, width=width, height=height), cv2.CAP_GSTREAMER)
         if len(self.uri) == 0:
             stream = cv2.VideoCapture(0)
-            estimate_fps = True
         else:
-            stream = cv2.VideoCapture(self.uri)
-            if self.uri.startswith('rtsp://'):
-                estimate_fps = True
+            params = []
+            if self.hw_decode and hasattr(cv2, 'CAP_PROP_HW_ACCELERATION'):
+                params += [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+            if self.live and hasattr(cv2, 'CAP_PROP_READ_TIMEOUT_MSEC'):
+                # a stalled network stream makes grab() fail after this instead of blocking for good
+                timeout = int(self.stale_seconds * 1000)
+                params += [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, timeout, cv2.CAP_PROP_READ_TIMEOUT_MSEC, timeout]
+            if len(params) > 0:
+                stream = cv2.VideoCapture(self.uri, cv2.CAP_FFMPEG, params)
             else:
-                estimate_fps = False
+                stream = cv2.VideoCapture(self.uri)
+        if self.decode_size is not None and stream.isOpened():
+            # cameras scale in the driver, network streams and files ignore this
+            width = stream.get(cv2.CAP_PROP_FRAME_WIDTH)
+            height = stream.get(cv2.CAP_PROP_FRAME_HEIGHT)
+            max_w, max_h = self.decode_size
+            if width > max_w or height > max_h:
+                ratio = min(max_w / width, max_h / height)
+                stream.set(cv2.CAP_PROP_FRAME_WIDTH, int(width * ratio))
+                stream.set(cv2.CAP_PROP_FRAME_HEIGHT, int(height * ratio))
+        return stream
+
+    def _put(self, frame, frame_id, timestamp):
+        if self.drop:
+            try:
+                self.queue.get(False)
+                self.dropped_count += 1
+            except Exception:
+                pass
+            self.queue.put((frame, frame_id, timestamp))
+            self.consumer_waiting.clear()
+        else:  # not drop
+            self.queue.put((frame, frame_id, timestamp))
+
+    def _sleep(self, seconds):
+        """Sleep, wake up early on stop"""
+        end = time.time() + seconds
+        while not self.stopped and time.time() < end:
+            time.sleep(min(0.1, end - time.time()))
+
+    def _capture(self, stream, frame_id):
+        """Read frames until the stream fails, ends, stalls or is stopped, return the last frame_id"""
+        estimate_fps = self.live
+        pace = not self.live and self.replay_start is None
+        video_fps = stream.get(cv2.CAP_PROP_FPS)
+        if not video_fps > 0:
+            video_fps = self.fps
+        start_time = time.time()
+        count = 0
+        last_decode = None
+        last_change = time.time()
+        last_signature = None
+        rate_time = time.time()
+        rate_count = self.decoded_count
+
+        while not self.stopped:
+            grabbed = stream.grab()
+            if not grabbed:
+                return frame_id
+            # the capture time of the frame, not the time it is processed
+            now = time.time()
+            frame_id += 1
+            timestamp = now
+            if self.replay_start is not None:
+                timestamp = self.replay_start + (frame_id - 1) / video_fps
+            count += 1
+            self.grabbed_count += 1
+            self.last_frame_time = now
+            if not self._should_decode(now, last_decode):
+                # this frame would be dropped, keep the stream going without decoding it
+                if pace:
+                    time.sleep(1.0 / self.fps)
+                continue
+            grabbed, frame = stream.retrieve()
+            if not grabbed:
+                return frame_id
+            self.decoded_count += 1
+            last_decode = now
+            if now - rate_time >= 1.0:
+                self.decode_rate = (self.decoded_count - rate_count) / (now - rate_time)
+                rate_time = now
+                rate_count = self.decoded_count
+
+            if self.live:
+                # a frozen camera keeps sending the same picture
+                signature = frame[::32, ::32].tobytes()
+                if signature != last_signature:
+                    last_signature = signature
+                    last_change = now
+                elif now - last_change > self.stale_seconds:
+                    print('QueuedStream: frozen stream', self.uri)
+                    return frame_id
+
+            self._put(frame, frame_id, timestamp)
+
+            if pace:
+                time.sleep(1.0 / self.fps)
+            elif estimate_fps:
+                if count > 25 and self.drop:
+                    self.fps = count / (time.time() - start_time)
+                elif count > 5 and self.drop:
+                    estimate = count / (time.time() - start_time)
+                    self.fps = (self.fps + estimate) / 2.0
+        return frame_id
+
+    def _thread_func(self):
+        '''keep looping infinitely'''
+        stream = self._open()
         time.sleep(0.1)
         self.opened = stream.isOpened()
+        self.connected = self.opened
 
         self.lock_started.release()
 
         if not self.opened:
             stream.release()
             return
-        start_time = time.time()
+        # frame ids keep increasing through reconnects
         frame_id = 0
+        delay = RECONNECT_MIN_DELAY
 
         while not self.stopped:
-            grabbed, frame = stream.read()
-            if not grabbed:
-                frame = None
-                frame_id = None
-            else:
-                frame_id += 1
-
-            if self.drop:
-                try:
-                    self.queue.get(False)
-                except Exception:
-                    pass
-                self.queue.put((frame, frame_id))
-            else:  # not drop
-                self.queue.put((frame, frame_id))
-
-            if frame is None:
+            frame_id = self._capture(stream, frame_id)
+            stream.release()
+            self.connected = False
+            if self.stopped or not self.live or not self.reconnect:
+                break
+            # reconnect with exponential backoff
+            while not self.stopped:
+                print('QueuedStream: reconnect', self.uri, 'in', delay, 'seconds')
+                self._sleep(delay)
+                if self.stopped:
+                    break
+                stream = self._open()
+                if stream.isOpened():
+                    self.connected = True
+                    self.reconnect_count += 1
+                    delay = RECONNECT_MIN_DELAY
+                    break
                 stream.release()
-                return
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
 
-            if not estimate_fps:
-                time.sleep(1.0 / self.fps)
-            else:
-                if frame_id > 25 and self.drop:
-                    self.fps = frame_id / (time.time() - start_time)
-                elif frame_id > 5 and self.drop:
-                    estimate = frame_id / (time.time() - start_time)
-                    self.fps = (self.fps + estimate) / 2.0
-        # stopped
-        if frame is not None:  # stopped.value == True
-            try:
-                self.queue.get(True, 0.5)
-            except Exception:
-                pass
-        else:
+        if not self.stopped:
+            # end of the stream, after the frames still queued
+            self._put(None, None, None)
             self.stopped = True
-        stream.release()
@@ -5,7 +5,9 @@ import numpy as np
 
 
 class WaitTimeEstimator:
-    def __init__(self):
+    def __init__(self, clock=time.time):
+        # time source, the video time when replaying a recording
+        self.clock = clock
         self.in_payment = dict()  # id -> (last_time, total_time)
         self.count = 0
         self.total_time = 0
@@ -29,9 +31,9 @@ class WaitTimeEstimator:
                 continue
             if self._is_in_payment_area(box):
                 if pid not in self.in_payment.keys():  # first time
-                    self.in_payment[pid] = [time.time(), 0]
+                    self.in_payment[pid] = [self.clock(), 0]
                 else:  # next time
-                    now = time.time()
+                    now = self.clock()
                     last_time = self.in_payment[pid][0]
                     if last_time is not None:
                         self.in_payment[pid][1] += now - last_time